@@ -1,6 +1,10 @@
 import argparse
 import os
 import glob
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from operator import attrgetter
 import numpy as np
 
 import pretty_midi
@@ -10,23 +14,28 @@ import mir_eval
 from omnizart.music import app as mapp
 
 
-def midi_to_notes(midi_path):
+def midi_to_notes(midi):
     """
-    Загружает MIDI-файл с помощью pretty_midi и возвращает списки:
+    Возвращает ноты MIDI в виде массивов:
     intervals: массив формы (N, 2) с начальными и конечными временами N нот
     pitches: массив с высотами нот (числовое значение MIDI-pitch)
+
+    midi может быть путём к MIDI-файлу, уже загруженным объектом PrettyMIDI
+    или готовой парой (intervals, pitches) - тогда она возвращается как есть.
     """
-    pm = pretty_midi.PrettyMIDI(midi_path)
-    intervals = []
-    pitches = []
-    for instrument in pm.instruments:
-        # Если нужно, можно дополнительно проверять instrument.is_drum
-        # или отфильтровывать инструменты по каналам, но для фортепиано
-        # обычно предполагается, что в файле 1-2 инструмента без перкуссии.
-        for note in instrument.notes:
-            intervals.append([note.start, note.end])
-            pitches.append(note.pitch)
-    return np.array(intervals), np.array(pitches)
+    if isinstance(midi, tuple):
+        return midi
+    pm = midi if isinstance(midi, pretty_midi.PrettyMIDI) else pretty_midi.PrettyMIDI(midi)
+    # Если нужно, можно дополнительно проверять instrument.is_drum
+    # или отфильтровывать инструменты по каналам, но для фортепиано
+    # обычно предполагается, что в файле 1-2 инструмента без перкуссии.
+    notes = [note for instrument in pm.instruments for note in instrument.notes]
+    count = len(notes)
+    # Заполняем массивы напрямую, без промежуточных списков на каждую ноту
+    starts = np.fromiter(map(attrgetter("start"), notes), dtype=np.float64, count=count)
+    ends = np.fromiter(map(attrgetter("end"), notes), dtype=np.float64, count=count)
+    pitches = np.fromiter(map(attrgetter("pitch"), notes), dtype=np.int64, count=count)
+    return np.column_stack((starts, ends)), pitches
 
 
 def evaluate_transcription(ref_midi, est_midi,
@@ -34,8 +43,9 @@ def evaluate_transcription(ref_midi, est_midi,
                            offset_ratio=0.2,
                            offset_min_tolerance=0.05):
     """
-    Сравнивает эталонный MIDI-файл (ref_midi) с оценочным (est_midi)
+    Сравнивает эталонный MIDI (ref_midi) с оценочным (est_midi)
     и возвращает метрики (Precision, Recall, F-measure и т.д.).
+    Оба аргумента принимаются в любом виде, который понимает midi_to_notes.
 
     Параметры onset_tolerance, offset_ratio и offset_min_tolerance
     можно настраивать в зависимости от требуемой точности определения
@@ -87,48 +97,188 @@ def evaluate_transcription(ref_midi, est_midi,
     }
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Скрипт для оценки качества транскрипции фортепиано модели Omnizart"
-    )
-    parser.add_argument("model_path", type=str, help="Путь к модели Omnizart.")
-    parser.add_argument("dataset_dir", type=str, help="Директория с .wav/.mid файлами-бенчмарком.")
-    args = parser.parse_args()
+REFERENCE_INDEX_NAME = ".reference_index.npz"
 
-    model_path = args.model_path
-    dataset_dir = args.dataset_dir
 
-    transcriber = mapp.MusicApp()
-    transcriber.load_model(model_path)
+def load_reference_notes(ref_mid_paths, index_path):
+    """
+    Возвращает словарь {путь к эталонному MIDI: (intervals, pitches)}.
 
-    wav_files = glob.glob(os.path.join(dataset_dir, "*.wav"))
+    Ноты всех эталонных файлов хранятся в одном .npz-индексе (index_path)
+    вместе с mtime и размером исходных файлов. Заново разбираются только
+    файлы, которых нет в индексе или которые изменились с момента его
+    построения; при любых изменениях индекс перезаписывается.
+    """
+    cached = {}
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            names = index["names"]
+            mtimes = index["mtimes"]
+            sizes = index["sizes"]
+            offsets = index["offsets"]
+            intervals = index["intervals"]
+            pitches = index["pitches"]
+        for i, name in enumerate(names):
+            start, end = offsets[i], offsets[i + 1]
+            cached[str(name)] = (mtimes[i], sizes[i], (intervals[start:end], pitches[start:end]))
 
-    metrics_list = []
+    result = {}
+    entries = []
+    changed = len(cached) != len(ref_mid_paths)
+    for ref_mid_path in ref_mid_paths:
+        name = os.path.basename(ref_mid_path)
+        stat = os.stat(ref_mid_path)
+        entry = cached.get(name)
+        if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+            entry = (stat.st_mtime_ns, stat.st_size, midi_to_notes(ref_mid_path))
+            changed = True
+        result[ref_mid_path] = entry[2]
+        entries.append((name, entry))
 
-    for wav_path in wav_files:
+    if changed:
+        offsets = np.cumsum([0] + [len(notes[1]) for _, (_, _, notes) in entries])
+        np.savez(
+            index_path,
+            names=np.array([name for name, _ in entries], dtype=str),
+            mtimes=np.array([mtime for _, (mtime, _, _) in entries], dtype=np.int64),
+            sizes=np.array([size for _, (_, size, _) in entries], dtype=np.int64),
+            offsets=offsets.astype(np.int64),
+            intervals=np.concatenate([notes[0].reshape(-1, 2) for _, (_, _, notes) in entries] or [np.empty((0, 2))]),
+            pitches=np.concatenate([notes[1] for _, (_, _, notes) in entries] or [np.empty(0, dtype=np.int64)]),
+        )
+    return result
+
+
+# Модель загружается в каждом процессе один раз, в init_worker
+_transcriber = None
+_model_path = None
+
+
+def init_worker(model_path):
+    """Инициализатор процесса-воркера: загружает модель Omnizart."""
+    global _transcriber, _model_path
+    _transcriber = mapp.MusicApp()
+    _transcriber.load_model(model_path)
+    _model_path = model_path
+
+
+def transcribe_file(wav_path):
+    """
+    Транскрибирует wav-файл моделью текущего процесса и возвращает ноты
+    в формате midi_to_notes, не записывая результат на диск.
+    """
+    print(f"Транскрибируем {wav_path}...")
+    est_pm = _transcriber.transcribe(wav_path, output=None, model_file=_model_path)
+    return midi_to_notes(est_pm)
+
+
+def find_pairs(dataset_dir):
+    """Возвращает список пар (wav, mid) из директории датасета."""
+    pairs = []
+    for wav_path in glob.glob(os.path.join(dataset_dir, "*.wav")):
         base_name = os.path.splitext(os.path.basename(wav_path))[0]
         ref_mid_path = os.path.join(dataset_dir, base_name + ".mid")
 
         if not os.path.exists(ref_mid_path):
             print(f"[Предупреждение] Для {wav_path} не найден {ref_mid_path}. Пропуск.")
             continue
+        pairs.append((wav_path, ref_mid_path))
+    return pairs
+
+
+def transcribe_all(model_path, wav_files, workers=1, chunk_size=1):
+    """
+    Транскрибирует wav-файлы и лениво возвращает ноты в порядке wav_files.
+
+    При workers > 1 файлы раздаются пулу процессов пачками по chunk_size,
+    модель загружается в каждом процессе один раз.
+    """
+    if workers <= 1:
+        init_worker(model_path)
+        yield from map(transcribe_file, wav_files)
+        return
+
+    # TensorFlow небезопасно использовать после fork, поэтому процессы запускаются через spawn
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker,
+                             initargs=(model_path,)) as executor:
+        yield from executor.map(transcribe_file, wav_files, chunksize=chunk_size)
+
+
+def read_results(results_path):
+    """
+    Читает JSONL-файл с результатами и возвращает словарь {имя файла: метрики}.
+    Недописанные строки (например, после падения процесса) пропускаются.
+    """
+    results = {}
+    if not os.path.exists(results_path):
+        return results
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[record.pop("file")] = record
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Скрипт для оценки качества транскрипции фортепиано модели Omnizart"
+    )
+    parser.add_argument("model_path", type=str, help="Путь к модели Omnizart.")
+    parser.add_argument("dataset_dir", type=str, help="Директория с .wav/.mid файлами-бенчмарком.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Число процессов для параллельной транскрипции.")
+    parser.add_argument("--chunk-size", type=int, default=1,
+                        help="Сколько файлов отдавать процессу-воркеру за раз.")
+    parser.add_argument("--results", type=str, default=None,
+                        help="JSONL-файл, в который построчно пишутся метрики "
+                             "(по умолчанию benchmark_results.jsonl в директории датасета).")
+    parser.add_argument("--resume", action="store_true",
+                        help="Продолжить прерванный запуск, пропустив файлы, для которых уже есть результаты.")
+    args = parser.parse_args()
+
+    model_path = args.model_path
+    dataset_dir = args.dataset_dir
 
-        print(f"Транскрибируем {wav_path}...")
+    results_path = args.results or os.path.join(dataset_dir, "benchmark_results.jsonl")
+    done = read_results(results_path) if args.resume else {}
 
-        est_pm = transcriber.transcribe(wav_path, output=None, model_file=model_path)
-        est_mid_path = os.path.join(dataset_dir, base_name + "_transcribed.mid")
-        est_pm.write(est_mid_path)
+    all_pairs = find_pairs(dataset_dir)
+    ref_notes = load_reference_notes([ref_mid_path for _, ref_mid_path in all_pairs],
+                                     os.path.join(dataset_dir, REFERENCE_INDEX_NAME))
+    pairs = [
+        (wav_path, ref_mid_path) for wav_path, ref_mid_path in all_pairs
+        if os.path.splitext(os.path.basename(wav_path))[0] not in done
+    ]
+    if done:
+        print(f"Пропускаем {len(done)} файлов с уже посчитанными метриками.")
+    wav_files = [wav_path for wav_path, _ in pairs]
 
-        # Считаем метрики
-        scores = evaluate_transcription(ref_mid_path, est_mid_path)
+    # Метрики пишутся в файл сразу после обработки каждого файла, чтобы прерванный запуск можно было продолжить
+    with open(results_path, "a+" if args.resume else "w", encoding="utf-8") as results_file:
+        size = results_file.tell()
+        if size > 0:
+            results_file.seek(size - 1)
+            if results_file.read(1) != "\n":
+                # Отделяем недописанную строку от новых записей
+                results_file.write("\n")
+        est_notes_iter = transcribe_all(model_path, wav_files, workers=args.workers, chunk_size=args.chunk_size)
+        for (wav_path, ref_mid_path), est_notes in zip(pairs, est_notes_iter):
+            base_name = os.path.splitext(os.path.basename(wav_path))[0]
 
-        metrics_list.append(scores)
-        print(f"Metrics for {base_name}:", scores)
+            # Считаем метрики
+            scores = evaluate_transcription(ref_notes[ref_mid_path], est_notes)
 
-        if os.path.exists(est_mid_path):
-            os.remove(est_mid_path)
+            results_file.write(json.dumps({"file": base_name, **scores}) + "\n")
+            results_file.flush()
+            print(f"Metrics for {base_name}:", scores)
 
     # Подсчитаем средние метрики по всем файлам
+    metrics_list = list(read_results(results_path).values())
     if len(metrics_list) == 0:
         print("Нет файлов для оценки или не найдены пары .wav/.mid.")
         return
@@ -1,44 +1,85 @@
 import os
-from tempfile import NamedTemporaryFile
 from pathlib import Path
 
-from cw.stand.service import Service, MODELS
+from cw.stand.jobs import JobQueue, JobStatus, QueueFullError
+from cw.stand.service import MODELS, registry
 
 import streamlit as st
 
 
+@st.cache_resource
+def preload_models() -> None:
+    """Один раз на процесс загружает модели, перечисленные в STAND_PRELOAD_MODELS (через запятую)"""
+    models = [model.strip() for model in os.getenv('STAND_PRELOAD_MODELS', '').split(',') if model.strip()]
+    registry.preload(models)
+
+
+@st.cache_resource
+def job_queue() -> JobQueue:
+    """Общая для всех сессий очередь задач на транскрипцию"""
+    return JobQueue(
+        max_workers=int(os.getenv('STAND_MAX_WORKERS', 1)),
+        max_pending=int(os.getenv('STAND_MAX_PENDING', 10)),
+        window=float(os.getenv('STAND_WINDOW_SECONDS', 60)),
+    )
+
+
 def gui() -> None:
     """Инициализирует графический интерфейс на streamlit"""
+    preload_models()
     st.title('Автоматическая транскрипция фортепианной музыки с помощью модели Omnizart')
     st.selectbox('Модель', options=MODELS.keys(), index=0, key='model_name')
     uploaded_file = st.file_uploader('Аудиофайл в формате .wav', ['wav'])
-
-    service = Service()
+    st.session_state.setdefault('job_ids', [])
 
     if st.button('Транскрибировать'):
         if uploaded_file is None:
             st.error('Пожалуйста, загрузите .wav файл.')
         else:
-            with st.spinner():
-                with NamedTemporaryFile(delete=False, suffix='.wav') as temp_wav:
-                    temp_wav.write(uploaded_file.read())
-                    wav_path = Path(temp_wav.name)
-
-                output_mid = wav_path.with_suffix('.mid')
-
-                service.transcribe(st.session_state['model_name'], wav_path, output_mid)
-
-                # Отображаем ссылку для скачивания .mid файла
-                with open(output_mid, 'rb') as f:
-                    st.download_button(
-                        label='Скачать результат (.mid)',
-                        data=f,
-                        file_name=os.path.basename(output_mid),
-                        mime='audio/midi'
-                    )
-
-                os.remove(wav_path)
-                os.remove(output_mid)
+            try:
+                job_id = job_queue().submit(st.session_state['model_name'], uploaded_file.name, uploaded_file.read())
+            except QueueFullError as e:
+                st.error(str(e))
+            else:
+                st.session_state['job_ids'].append(job_id)
+
+    jobs()
+
+
+@st.fragment(run_every=2)
+def jobs() -> None:
+    """Отображает статус задач текущей сессии, периодически обновляясь"""
+    queue = job_queue()
+    for job_id in list(st.session_state['job_ids']):
+        job = queue.get(job_id)
+        if job is None:
+            st.session_state['job_ids'].remove(job_id)
+            continue
+
+        st.progress(job.progress, text=f'{job.file_name} ({job.model}): {job.status.value}')
+        if job.status == JobStatus.DONE:
+            # Отображаем ссылку для скачивания .mid файла, после скачивания результат удаляется
+            st.download_button(
+                label='Скачать результат (.mid)',
+                data=job.result,
+                file_name=Path(job.file_name).with_suffix('.mid').name,
+                mime='audio/midi',
+                key=job_id,
+                on_click=queue.pop,
+                args=(job_id,),
+            )
+        elif job.status == JobStatus.RUNNING and job.result is not None:
+            st.download_button(
+                label='Скачать промежуточный результат (.mid)',
+                data=job.result,
+                file_name=Path(job.file_name).stem + '_partial.mid',
+                mime='audio/midi',
+                key=f'{job_id}_partial',
+            )
+        elif job.status == JobStatus.FAILED:
+            # Ошибка остается на экране, пока пользователь ее не скроет
+            st.error(job.error)
+            st.button('Скрыть', key=f'{job_id}_dismiss', on_click=queue.pop, args=(job_id,))
 
 
 if __name__ == '__main__':
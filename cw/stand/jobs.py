@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from io import BytesIO
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Dict, Optional
+
+import pretty_midi
+
+from cw.stand.service import Service
+
+
+class JobStatus(str, Enum):
+    QUEUED = 'В очереди'
+    RUNNING = 'Транскрибируется'
+    DONE = 'Готово'
+    FAILED = 'Ошибка'
+
+
+@dataclass
+class Job:
+    """Задача на транскрипцию одного файла"""
+    id: str
+    model: str
+    file_name: str
+    status: JobStatus = JobStatus.QUEUED
+    progress: float = 0.0
+    result: Optional[bytes] = None
+    error: Optional[str] = None
+    created: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None  # время завершения, от него отсчитывается срок хранения результата
+
+
+class QueueFullError(Exception):
+    """Очередь задач переполнена"""
+
+
+class JobQueue:
+    """
+    Внутрипроцессная очередь задач на транскрипцию
+
+    Задачи выполняются пулом из max_workers потоков, что ограничивает число одновременных инференсов модели. Файлы
+    транскрибируются окнами по window секунд, промежуточный результат доступен в Job.result до завершения задачи.
+    Новые задачи не принимаются, пока в очереди и в работе больше max_pending задач. Результаты хранятся до
+    явного удаления через pop(), но не дольше ttl секунд после завершения задачи
+    """
+
+    def __init__(self, max_workers: int = 1, max_pending: int = 10, ttl: float = 60 * 60, window: float = 60.0):
+        self.max_pending = max_pending
+        self.window = window
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='transcription')
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._service = Service()
+
+    def submit(self, model: str, file_name: str, data: bytes) -> str:
+        """Ставит файл в очередь на транскрипцию и возвращает идентификатор задачи"""
+        with self._lock:
+            self._cleanup()
+            pending = sum(job.status in (JobStatus.QUEUED, JobStatus.RUNNING) for job in self._jobs.values())
+            if pending >= self.max_pending:
+                raise QueueFullError('Слишком много задач в очереди, попробуйте позже')
+            job = Job(uuid.uuid4().hex, model, file_name)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, data)
+        return job.id
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Возвращает задачу по идентификатору"""
+        return self._jobs.get(job_id)
+
+    def pop(self, job_id: str) -> Optional[Job]:
+        """Удаляет задачу вместе с результатом"""
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def _cleanup(self) -> None:
+        now = time.monotonic()
+        for job_id in [job.id for job in self._jobs.values()
+                       if job.finished is not None and now - job.finished > self.ttl]:
+            del self._jobs[job_id]
+
+    def _run(self, job: Job, data: bytes) -> None:
+        job.status = JobStatus.RUNNING
+        job.progress = 0.1
+        with NamedTemporaryFile(delete=False, suffix='.wav') as temp_wav:
+            temp_wav.write(data)
+            wav_path = Path(temp_wav.name)
+        output_mid = wav_path.with_suffix('.mid')
+        try:
+            def on_progress(pm: pretty_midi.PrettyMIDI, progress: float) -> None:
+                buffer = BytesIO()
+                pm.write(buffer)
+                job.result = buffer.getvalue()
+                job.progress = max(job.progress, progress)
+
+            self._service.transcribe(job.model, wav_path, output_mid, window=self.window, on_progress=on_progress)
+            job.result = output_mid.read_bytes()
+            job.status = JobStatus.DONE
+        except Exception as e:
+            job.error = str(e)
+            job.status = JobStatus.FAILED
+        finally:
+            job.progress = 1.0
+            job.finished = time.monotonic()
+            for path in (wav_path, output_mid):
+                if path.exists():
+                    os.remove(path)
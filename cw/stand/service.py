@@ -1,22 +1,99 @@
+import os
+import threading
+from collections import OrderedDict
 from functools import cached_property
 from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+import pretty_midi
 
 import omnizart
 from omnizart.music import MusicTranscription
 
+from cw.stand.streaming import transcribe_streaming
+
 MODELS = {
     'piano (Pretrained)': '/home/ssemion/venv8/lib/python3.8/site-packages/omnizart/checkpoints/music/music_piano',
     'piano (Finetiuned)': 'cw/model',
 }
 
+
+class ModelRegistry:
+    """
+    Общий для процесса реестр загруженных чекпоинтов Omnizart
+
+    Держит в памяти не более max_loaded моделей, при превышении выгружает давно не использованную
+    """
+
+    def __init__(self, max_loaded: int = 2):
+        self.max_loaded = max_loaded
+        self._models: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_path: str, load: Callable[[], Any]) -> Any:
+        """Возвращает загруженную модель, при необходимости загружая ее через load()"""
+        with self._lock:
+            if model_path in self._models:
+                self._models.move_to_end(model_path)
+                return self._models[model_path]
+            loaded = load()
+            self._models[model_path] = loaded
+            while len(self._models) > self.max_loaded:
+                self._models.popitem(last=False)
+            return loaded
+
+    def preload(self, models: Iterable[str]) -> None:
+        """Загружает указанные модели из MODELS заранее"""
+        transcription = RegistryMusicTranscription()
+        for model in models:
+            transcription._load_model(MODELS[model])
+
+
+registry = ModelRegistry(max_loaded=int(os.getenv('STAND_MAX_LOADED_MODELS', 2)))
+
+
+class RegistryMusicTranscription(MusicTranscription):
+    """MusicTranscription, берущая модели из общего реестра вместо загрузки чекпоинта на каждый вызов"""
+
+    def _load_model(self, model_path=None, custom_objects=None):
+        return registry.get(model_path, lambda: super(RegistryMusicTranscription, self)._load_model(
+            model_path, custom_objects=custom_objects,
+        ))
+
+
 class Service:
     @cached_property
     def transcription(self):
-        return MusicTranscription()
+        return RegistryMusicTranscription()
+
+    def transcribe(
+        self,
+        model: str,
+        wav_path: Path,
+        mid_path: Path,
+        window: Optional[float] = None,
+        overlap: float = 5.0,
+        on_progress: Optional[Callable[[pretty_midi.PrettyMIDI, float], None]] = None,
+    ) -> None:
+        """
+        Транскрибирует wav-файл в mid-файл
+
+        Если задан window, файл обрабатывается перекрывающимися окнами длиной window секунд, и потребление памяти не
+        зависит от длины записи. on_progress получает промежуточный результат после каждого окна
+        """
+        if window is None:
+            self.transcription.transcribe(
+                str(wav_path),
+                model_path=MODELS[model],
+                output=str(mid_path),
+            )
+            return
 
-    def transcribe(self, model: str, wav_path: Path, mid_path: Path) -> None:
-        self.transcription.transcribe(
-            str(wav_path),
-            model_path=MODELS[model],
-            output=str(mid_path),
+        pm = transcribe_streaming(
+            wav_path,
+            lambda path: self.transcription.transcribe(str(path), model_path=MODELS[model], output=None),
+            window=window,
+            overlap=overlap,
+            on_progress=on_progress,
         )
+        pm.write(str(mid_path))
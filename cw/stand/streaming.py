@@ -0,0 +1,123 @@
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pretty_midi
+from scipy.io import wavfile
+
+# Нота, обрезанная концом окна, считается продолжающейся в следующем окне, если заканчивается ближе этого к границе
+BOUNDARY_TOLERANCE = 0.05
+
+
+@dataclass
+class Window:
+    """Окно аудиофайла, транскрибированное отдельно"""
+    start: float
+    end: float
+    is_last: bool
+    notes: Dict[int, List[pretty_midi.Note]]  # ноты по номеру программы, время абсолютное
+
+
+def iter_windows(wav_path: Path, window: float, overlap: float) -> Iterator[Tuple[float, float, bool, Path]]:
+    """
+    Нарезает wav-файл на перекрывающиеся окна длиной window секунд с перекрытием overlap секунд
+
+    Файл читается через memory-mapped I/O, поэтому в памяти одновременно находится только текущее окно. Для каждого окна
+    возвращает начало и конец в секундах, признак последнего окна и путь к временному wav-файлу, который удаляется
+    после перехода к следующему окну
+    """
+    if overlap >= window:
+        raise ValueError('Перекрытие должно быть меньше длины окна')
+    rate, samples = wavfile.read(str(wav_path), mmap=True)
+    total = len(samples)
+    start = 0.0
+    while True:
+        first, last = int(start * rate), min(total, int((start + window) * rate))
+        with NamedTemporaryFile(suffix='.wav') as temp_wav:
+            wavfile.write(temp_wav.name, rate, np.asarray(samples[first:last]))
+            yield start, last / rate, last >= total, Path(temp_wav.name)
+        if last >= total:
+            return
+        start += window - overlap
+
+
+def _finalize(
+    window: Window, next_window: Optional[Window], overlap: float,
+) -> Dict[int, List[pretty_midi.Note]]:
+    """
+    Оставляет ноты окна, начинающиеся в его зоне ответственности, и продлевает ноты, обрезанные концом окна
+
+    Зона ответственности окна - его интервал без половин перекрытий с соседними окнами, поэтому каждая нота из
+    перекрытия попадает в результат ровно один раз. Продолжением ноты считается нота той же высоты из следующего окна,
+    которая начинается в перекрытии не раньше самой ноты и не позже ее начала или начала следующего окна: нота,
+    начавшаяся до следующего окна, видна в нем обрезанной с его начала, а начавшаяся в перекрытии - со своего начала
+    """
+    low = window.start + overlap / 2 if window.start > 0 else -np.inf
+    high = window.end - overlap / 2 if not window.is_last else np.inf
+    result = {}
+    for program, notes in window.notes.items():
+        kept = [note for note in notes if low <= note.start < high]
+        if next_window is not None:
+            for note in kept:
+                if note.end < window.end - BOUNDARY_TOLERANCE:
+                    continue
+                latest_start = max(note.start, next_window.start) + BOUNDARY_TOLERANCE
+                continuations = [other.end for other in next_window.notes.get(program, [])
+                                 if other.pitch == note.pitch
+                                 and note.start - BOUNDARY_TOLERANCE <= other.start <= latest_start]
+                if continuations:
+                    note.end = max(note.end, *continuations)
+        result[program] = kept
+    return result
+
+
+def _to_pretty_midi(notes: Dict[int, List[pretty_midi.Note]]) -> pretty_midi.PrettyMIDI:
+    pm = pretty_midi.PrettyMIDI()
+    for program, program_notes in sorted(notes.items()):
+        instrument = pretty_midi.Instrument(program=program)
+        instrument.notes = sorted(program_notes, key=lambda note: (note.start, note.pitch))
+        pm.instruments.append(instrument)
+    return pm
+
+
+def transcribe_streaming(
+    wav_path: Path,
+    transcribe: Callable[[Path], pretty_midi.PrettyMIDI],
+    window: float = 60.0,
+    overlap: float = 5.0,
+    on_progress: Optional[Callable[[pretty_midi.PrettyMIDI, float], None]] = None,
+) -> pretty_midi.PrettyMIDI:
+    """
+    Транскрибирует wav-файл по окнам функцией transcribe и склеивает результат в один PrettyMIDI
+
+    on_progress, если передан, вызывается после каждого окна с промежуточным результатом и долей обработанного файла
+    """
+    rate, samples = wavfile.read(str(wav_path), mmap=True)
+    duration = len(samples) / rate
+    del samples
+
+    merged: Dict[int, List[pretty_midi.Note]] = {}
+    previous = None
+    for start, end, is_last, path in iter_windows(wav_path, window, overlap):
+        notes = {}
+        for instrument in transcribe(path).instruments:
+            notes.setdefault(instrument.program, []).extend(
+                pretty_midi.Note(note.velocity, note.pitch, note.start + start, note.end + start)
+                for note in instrument.notes
+            )
+        current = Window(start, end, is_last, notes)
+        if previous is not None:
+            for program, program_notes in _finalize(previous, current, overlap).items():
+                merged.setdefault(program, []).extend(program_notes)
+            if on_progress is not None:
+                on_progress(_to_pretty_midi(merged), previous.end / duration)
+        previous = current
+
+    for program, program_notes in _finalize(previous, None, overlap).items():
+        merged.setdefault(program, []).extend(program_notes)
+    pm = _to_pretty_midi(merged)
+    if on_progress is not None:
+        on_progress(pm, 1.0)
+    return pm
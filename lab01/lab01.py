@@ -1,7 +1,13 @@
+import argparse
+import asyncio
+import contextlib
 import csv
+import hashlib
 import json
 import os
-import sys
+import sqlite3
+import threading
+import time
 from abc import ABC, abstractmethod
 from collections import defaultdict
 from dataclasses import dataclass
@@ -9,8 +15,8 @@ from datetime import datetime
 from functools import cached_property
 from typing import Any, Iterator
 
-import requests
 import streamlit as st
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 
 PROMPT = """Найди все упомянутые даты и время в тексте. Верни ответ в формате списка json, содержащего строки в формате 
 ISO 8601. Пример ответа: ["2024-09-30T01:16:00", "2025-01-01", "14:56:06"}]. 
@@ -39,8 +45,114 @@ class Dataset:
                 yield TextItem(text, set(json.loads(entities)))
 
 
+class TokenBucket:
+    """Ограничитель частоты запросов по алгоритму token bucket"""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Ждет, пока в ведре не появится свободный токен"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RequestLimiter:
+    """Ограничивает число одновременных запросов к модели и их частоту"""
+
+    def __init__(self, max_concurrency: int, rate_limit: float):
+        self._semaphore = asyncio.BoundedSemaphore(max_concurrency)
+        self._bucket = TokenBucket(rate_limit, capacity=max_concurrency)
+
+    async def __aenter__(self) -> 'RequestLimiter':
+        await self._semaphore.acquire()
+        await self._bucket.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._semaphore.release()
+
+
+class ResponseCache:
+    """
+    Персистентный кэш ответов моделей в SQLite
+
+    Ключ записи - хэш от содержимого запроса. Записи старше ttl секунд считаются устаревшими, при превышении max_entries
+    вытесняются давно не использованные записи (LRU)
+    """
+
+    def __init__(self, filename: str, max_entries: int = 10_000, ttl: float = 30 * 24 * 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                           'key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """Строит ключ записи по содержимому запроса"""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key: str) -> Any | None:
+        """Возвращает закэшированный ответ или None, если его нет или он устарел"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        """Сохраняет ответ и вытесняет давно не использованные записи сверх лимита"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                               (key, json.dumps(value, ensure_ascii=False), now, now))
+            self._conn.execute('DELETE FROM responses WHERE key IN ('
+                               'SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                               (self.max_entries,))
+            self._conn.commit()
+
+
 class BaseGPTClient(ABC):
-    """Базовый клиент к GPT-модели для поиска именованных сущностей"""
+    """
+    Базовый асинхронный клиент к GPT-модели для поиска именованных сущностей
+
+    Запросы идут через пул соединений aiohttp, который открывается при первом запросе и живет до вызова close()
+    """
+
+    MAX_CONCURRENCY = 4  # максимальное число одновременных запросов к модели
+    RATE_LIMIT = 5.0  # максимальное число запросов к модели в секунду
+    LIMIT_PER_HOST = 10  # ограничение на число соединений к одному хосту
+    KEEPALIVE_TIMEOUT = 30.0  # сколько секунд держать простаивающее соединение открытым
+    TIMEOUT = 60.0  # дедлайн запроса в секундах
+
+    cache: ResponseCache | None = None
+    limiter: RequestLimiter | None = None  # применяется только к запросам, не найденным в кэше
+    _session: ClientSession | None = None
 
     @property
     @abstractmethod
@@ -52,7 +164,7 @@ class BaseGPTClient(ABC):
         pass
 
     @abstractmethod
-    def find_entities(self, text: str) -> Iterator[str]:
+    async def find_entities(self, text: str) -> list[str]:
         pass
 
     @property
@@ -65,10 +177,34 @@ class BaseGPTClient(ABC):
     def URL(self) -> str:
         pass
 
-    def make_request(self, text: str) -> dict[str, Any]:
-        r = requests.post(self.URL, json=self._get_json(text), headers=self.headers)
-        r.raise_for_status()
-        return r.json()
+    async def start(self) -> None:
+        """Открывает пул соединений клиента"""
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(limit_per_host=self.LIMIT_PER_HOST, keepalive_timeout=self.KEEPALIVE_TIMEOUT),
+                timeout=ClientTimeout(total=self.TIMEOUT),
+            )
+
+    async def close(self) -> None:
+        """Закрывает пул соединений клиента"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def make_request(self, text: str) -> dict[str, Any]:
+        payload = self._get_json(text)
+        if self.cache is not None:
+            key = self.cache.make_key(self.name, self.URL, payload)
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+        await self.start()
+        async with self.limiter or contextlib.nullcontext():
+            async with self._session.post(self.URL, json=payload, headers=self.headers, raise_for_status=True) as r:
+                data = await r.json(content_type=None)
+        if self.cache is not None:
+            self.cache.set(key, data)
+        return data
 
 
 class YandexGPTClient(BaseGPTClient):
@@ -98,9 +234,9 @@ class YandexGPTClient(BaseGPTClient):
             ],
         }
 
-    def find_entities(self, text: str) -> Iterator[str]:
-        data = self.make_request(text)
-        yield from json.loads(data['result']['alternatives'][0]['message']['text'])
+    async def find_entities(self, text: str) -> list[str]:
+        data = await self.make_request(text)
+        return json.loads(data['result']['alternatives'][0]['message']['text'])
 
 
 class ChatGPTClient(BaseGPTClient):
@@ -126,19 +262,44 @@ class ChatGPTClient(BaseGPTClient):
             "stop": ["<|im_start|>", "<|im_end|>"]
         }
 
-    def find_entities(self, text: str) -> Iterator[str]:
-        data = self.make_request(text)
-        yield from json.loads(data['result'])
+    async def find_entities(self, text: str) -> list[str]:
+        data = await self.make_request(text)
+        return json.loads(data['result'])
+
+
+async def find_entities_limited(i: int, model: BaseGPTClient, semaphore: asyncio.Semaphore, text: str) -> set[str]:
+    """Выполняет запрос к модели с учетом ограничения на общее число одновременных запросов"""
+    async with semaphore:
+        print(f'[{i}] Делаем запрос в {model.name}')
+        return set(await model.find_entities(text))
 
 
-def calc_score(models: list[BaseGPTClient]) -> None:
-    """Загружает датасет и считает метрики для каждой модели"""
+async def calc_score(models: list[BaseGPTClient], concurrency: int = 1) -> None:
+    """
+    Загружает датасет и считает метрики для каждой модели
+
+    Запросы по всем строкам и моделям выполняются конкурентно, не более concurrency одновременно, при этом для каждой
+    модели соблюдаются ограничения MAX_CONCURRENCY и RATE_LIMIT, которые не расходуются на ответы из кэша. Очки
+    суммируются в порядке строк датасета, поэтому результат не зависит от порядка завершения запросов
+    """
     scores = defaultdict(int)
-    dataset = Dataset('ai/lab01_data.csv')
+    dataset = list(Dataset('ai/lab01_data.csv'))
+    for model in models:
+        model.limiter = RequestLimiter(model.MAX_CONCURRENCY, model.RATE_LIMIT)
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        results = await asyncio.gather(*(
+            find_entities_limited(i, model, semaphore, item.text)
+            for i, item in enumerate(dataset, 1)
+            for model in models
+        ))
+    finally:
+        await asyncio.gather(*(model.close() for model in models))
+
+    results = iter(results)
     for i, item in enumerate(dataset, 1):
         for model in models:
-            print(f'[{i}] Делаем запрос в {model.name}')
-            result = set(model.find_entities(item.text))
+            result = next(results)
 
             if item.entities:
                 scores[model] += len(result & item.entities) / len(item.entities)
@@ -148,23 +309,61 @@ def calc_score(models: list[BaseGPTClient]) -> None:
     for model, score in scores.items():
         print(f'Total {model.name} score: {score / i * 100:.2f}%')
 
+    for cache in {model.cache for model in models if model.cache is not None}:
+        print(f'Cache hits: {cache.hits}, misses: {cache.misses}')
+
 
-def gui(models: list[BaseGPTClient]) -> None:
+def make_models(use_cache: bool = True) -> list[BaseGPTClient]:
+    models = [
+        YandexGPTClient(folder=os.getenv('YC_FOLDER'), token=os.getenv('YC_TOKEN')),
+        YandexGPTClient(folder=os.getenv('YC_FOLDER'), token=os.getenv('YC_TOKEN'), model='yandexgpt/latest'),
+        ChatGPTClient(token=os.getenv('RAPIDAPI_CHATGPT_TOKEN')),
+    ]
+    if use_cache:
+        cache = ResponseCache(os.path.join(os.path.dirname(__file__), 'lab01_cache.sqlite3'))
+        for model in models:
+            model.cache = cache
+    return models
+
+
+@st.cache_resource
+def gui_resources(use_cache: bool) -> tuple[list[BaseGPTClient], asyncio.AbstractEventLoop]:
+    """
+    Клиенты и цикл событий в фоновом потоке, общие для всех перезапусков скрипта streamlit
+
+    Пулы соединений клиентов привязаны к этому циклу, поэтому переиспользуются между запросами пользователя
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return make_models(use_cache), loop
+
+
+async def find_all_entities(models: list[BaseGPTClient], text: str) -> list[list[str] | Exception]:
+    """Опрашивает все модели одновременно, ошибка одной из них возвращается вместо ее результата"""
+    return await asyncio.gather(*(model.find_entities(text) for model in models), return_exceptions=True)
+
+
+def gui(models: list[BaseGPTClient], loop: asyncio.AbstractEventLoop) -> None:
     """Инициализирует streamlit GUI"""
     q = st.text_area("Введите текст")
     button = st.button("Найти даты")
     if button:
         if q:
-            for model in models:
+            # Опрашиваем все модели одновременно: ждать приходится только самую медленную из них
+            with st.spinner():
+                results = asyncio.run_coroutine_threadsafe(find_all_entities(models, q), loop).result()
+            for model, result in zip(models, results):
                 st.markdown(f'###### {model.name}')
-                with st.spinner():
-                    dates = []
-                    for item in model.find_entities(q):
-                        try:
-                            d = datetime.fromisoformat(item)
-                        except ValueError:
-                            d = f'{item} [Invalid ISO format]'
-                        dates.append(d)
+                if isinstance(result, Exception):
+                    st.error(f'Ошибка запроса: {result}')
+                    continue
+                dates = []
+                for item in result:
+                    try:
+                        d = datetime.fromisoformat(item)
+                    except ValueError:
+                        d = f'{item} [Invalid ISO format]'
+                    dates.append(d)
                 if not dates:
                     st.write('Дат не найдено')
                 else:
@@ -174,17 +373,14 @@ def gui(models: list[BaseGPTClient]) -> None:
 
 
 def main():
-    models = [
-        YandexGPTClient(folder=os.getenv('YC_FOLDER'), token=os.getenv('YC_TOKEN')),
-        YandexGPTClient(folder=os.getenv('YC_FOLDER'), token=os.getenv('YC_TOKEN'), model='yandexgpt/latest'),
-        ChatGPTClient(token=os.getenv('RAPIDAPI_CHATGPT_TOKEN')),
-    ]
-    _, *args = sys.argv
-    if not args:
-        return gui(models)
-    if len(args) == 1 and args[0] == 'metrics':
-        return calc_score(models)
-    raise Exception('Invalid args')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', nargs='?', choices=['metrics'], help='Посчитать метрики вместо запуска GUI')
+    parser.add_argument('--concurrency', type=int, default=1, help='Число параллельных запросов при подсчете метрик')
+    parser.add_argument('--no-cache', action='store_true', help='Не использовать кэш ответов моделей')
+    args = parser.parse_args()
+    if args.mode is None:
+        return gui(*gui_resources(not args.no_cache))
+    return asyncio.run(calc_score(make_models(not args.no_cache), concurrency=args.concurrency))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+"""
+Бенчмарк генерации для сервисов lab02
+
+Для каждой модели из MODELS по очереди перебирает значения параметров генерации из GENERATIVE_PARAMS (остальные
+параметры при этом равны значениям по умолчанию) и измеряет время загрузки, время до первого токена, скорость генерации,
+p50/p95 задержки и пиковую память. Пример запуска:
+    python -m lab02.benchmark --output bench.json
+    python -m lab02.benchmark --baseline bench.json
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from transformers import TextIteratorStreamer
+
+from lab02.services.const import MODELS, GENERATIVE_PARAMS, BASE_TEXT
+
+SWEEP_PARAMS = ('max_length', 'top_k', 'top_p', 'repetition_penalty')
+
+
+def sweep_values(param: str, points: int, minimum: float | None = None) -> list:
+    """
+    Равномерно распределенные значения параметра в его допустимом диапазоне, включая значение по умолчанию
+
+    Значения меньше minimum, если он задан, заменяются на minimum
+    """
+    spec = GENERATIVE_PARAMS[param]
+    values = np.linspace(spec.min, spec.max, points)
+    if isinstance(spec.default, int):
+        values = np.round(values).astype(int)
+    values = {*values.tolist(), spec.default}
+    if minimum is not None:
+        values = {max(value, minimum) for value in values}
+    return sorted(values)
+
+
+def run_once(model_name: str, prompt: str, params: dict) -> tuple[float, float, int]:
+    """Выполняет одну генерацию и возвращает время до первого токена, общее время и число новых токенов"""
+    service = MODELS[model_name]
+    input_ids = service.tokenizer.encode(prompt, return_tensors='pt')
+    streamer = TextIteratorStreamer(service.tokenizer, skip_prompt=True)
+    start = time.monotonic()
+    ttft = None
+    stream = service.stream_generate(streamer, input_ids, attention_mask=torch.ones_like(input_ids), do_sample=True,
+                                     pad_token_id=service.tokenizer.eos_token_id, **params)
+    while True:
+        try:
+            next(stream)
+        except StopIteration as stop:
+            output = stop.value
+            break
+        if ttft is None:
+            ttft = time.monotonic() - start
+    total = time.monotonic() - start
+    return ttft if ttft is not None else total, total, output.shape[1] - input_ids.shape[1]
+
+
+def benchmark_model(model_name: str, points: int, repeats: int, prompt: str) -> list[dict]:
+    """Измеряет одну модель, вызывается в отдельном процессе, чтобы пиковая память не смешивалась между моделями"""
+    service = MODELS[model_name]
+    start = time.monotonic()
+    service.loaded
+    load_time = time.monotonic() - start
+
+    # max_length включает промпт, и generate отвергает значения не длиннее него
+    min_length = len(service.tokenizer.encode(prompt)) + 1
+    defaults = {param: spec.default for param, spec in GENERATIVE_PARAMS.items()}
+    defaults['max_length'] = max(defaults['max_length'], min_length)
+    rows = []
+    for param in SWEEP_PARAMS:
+        for value in sweep_values(param, points, minimum=min_length if param == 'max_length' else None):
+            params = {**defaults, param: value}
+            runs = [run_once(model_name, prompt, params) for _ in range(repeats)]
+            ttfts, latencies, tokens = map(np.array, zip(*runs))
+            rows.append({
+                'model': model_name,
+                'param': param,
+                'value': value,
+                'load_time': load_time,
+                'ttft_p50': float(np.percentile(ttfts, 50)),
+                'tokens_per_sec': float(tokens.sum() / latencies.sum()),
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p95': float(np.percentile(latencies, 95)),
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            })
+    return rows
+
+
+def find_regressions(rows: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """Сравнивает результаты с сохраненными и возвращает описания ухудшений больше чем на tolerance"""
+    baseline_rows = {(row['model'], row['param'], str(row['value'])): row for row in baseline}
+    regressions = []
+    for row in rows:
+        base = baseline_rows.get((row['model'], row['param'], str(row['value'])))
+        if base is None:
+            continue
+        name = f"{row['model']} {row['param']}={row['value']}"
+        if float(row['tokens_per_sec']) < float(base['tokens_per_sec']) * (1 - tolerance):
+            regressions.append(f"{name}: tokens_per_sec {float(base['tokens_per_sec']):.2f} -> {row['tokens_per_sec']:.2f}")
+        for metric in ('ttft_p50', 'latency_p95', 'peak_rss_mb'):
+            if float(row[metric]) > float(base[metric]) * (1 + tolerance):
+                regressions.append(f'{name}: {metric} {float(base[metric]):.2f} -> {row[metric]:.2f}')
+    return regressions
+
+
+def read_rows(path: str) -> list[dict]:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f) if path.endswith('.json') else list(csv.DictReader(f))
+
+
+def write_rows(rows: list[dict], path: str | None) -> None:
+    if path is not None and path.endswith('.csv'):
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        return
+    data = json.dumps(rows, indent=2, ensure_ascii=False)
+    if path is None:
+        print(data)
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк генерации моделей lab02')
+    parser.add_argument('--models', nargs='*', choices=list(MODELS), default=list(MODELS), help='Модели для замера')
+    parser.add_argument('--points', type=int, default=3, help='Число значений каждого параметра')
+    parser.add_argument('--repeats', type=int, default=3, help='Число повторов на каждое значение')
+    parser.add_argument('--prompt', default=BASE_TEXT, help='Входной текст')
+    parser.add_argument('--output', default=None, help='Файл .json или .csv для результатов, по умолчанию stdout')
+    parser.add_argument('--baseline', default=None, help='Сохраненные результаты (.json или .csv) для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Допустимое относительное ухудшение метрик')
+    args = parser.parse_args()
+
+    rows = []
+    for model_name in args.models:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            rows += executor.submit(benchmark_model, model_name, args.points, args.repeats, args.prompt).result()
+    write_rows(rows, args.output)
+
+    if args.baseline is not None:
+        regressions = find_regressions(rows, read_rows(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f'[Регрессия] {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,15 @@
+import os
 from dataclasses import dataclass, field
 from datetime import datetime
+from time import monotonic
 from typing import Literal
 
 import streamlit as st
 
+from lab02.services.batching import GenerationBatcher
 from lab02.services.const import MODELS, GENERATIVE_PARAMS, BASE_TEXT
+from lab02.services.registry import registry
+from lab02.services.session import ChatSession
 
 
 @dataclass
@@ -16,8 +21,31 @@ class Message:
     meta: str | None = None
 
 
+@st.cache_resource
+def warm_up() -> None:
+    """Один раз на процесс загружает в фоне модели, перечисленные в LAB02_WARM_UP (через запятую)"""
+    names = [name.strip() for name in os.getenv('LAB02_WARM_UP', '').split(',') if name.strip()]
+    if names:
+        registry.warm_up([MODELS[name] for name in names])
+
+
+@st.cache_resource
+def batchers() -> dict[str, GenerationBatcher]:
+    """
+    Общие для всех сессий пакетировщики запросов, включаются переменной LAB02_BATCH_SIZE > 1
+
+    В пакетном режиме ответ не стримится и история диалога не учитывается
+    """
+    max_batch_size = int(os.getenv('LAB02_BATCH_SIZE', 1))
+    if max_batch_size <= 1:
+        return {}
+    max_wait = float(os.getenv('LAB02_BATCH_MAX_WAIT', 0.05))
+    return {name: GenerationBatcher(model, max_batch_size, max_wait) for name, model in MODELS.items()}
+
+
 def gui() -> None:
     """Инициализирует графический интерфейс на streamlit"""
+    warm_up()
     sidebar()
     st.session_state.setdefault('messages', [])
     st.title('Чат с ruGPT-3 от SberDevices')
@@ -48,17 +76,43 @@ def send_message(text: str) -> None:
 
     name = st.session_state['model_name']
     avatar = 'assistant'
-    with st.chat_message(name=name, avatar=avatar), st.spinner():
-        model = MODELS[name]
+    with st.chat_message(name=name, avatar=avatar):
         params = {param_key: st.session_state[param_key] for param_key in GENERATIVE_PARAMS}
-        gpt_message = Message(name, avatar, model.send_message(text, **params), meta=str(params))
+        meta = dict(params)
+        # Время загрузки модели учитываем отдельно от времени генерации
+        if not MODELS[name].is_loaded:
+            with st.spinner('Загрузка модели'):
+                meta['load_time'] = round(MODELS[name].loaded.load_time, 2)
+        start = monotonic()
+        if name in batchers():
+            with st.spinner():
+                answer = batchers()[name].send_message(text, **params)
+            st.write(answer)
+        else:
+            # Текст выводится по мере генерации токенов
+            answer = st.write_stream(chat_session(name).stream_message(text, **params))
+        meta['generation_time'] = round(monotonic() - start, 2)
+        gpt_message = Message(name, avatar, answer, meta=str(meta))
         st.session_state['messages'].append(gpt_message)
-        render_message(gpt_message)
+        render_caption(gpt_message)
+
+
+def chat_session(name: str) -> ChatSession:
+    """Возвращает сессию диалога с моделью, хранящую историю и KV-кэш между репликами"""
+    sessions = st.session_state.setdefault('chat_sessions', {})
+    if name not in sessions:
+        sessions[name] = ChatSession(MODELS[name])
+    return sessions[name]
 
 
 def render_message(message: Message) -> None:
     """Отрисовывает контент сообщения на экране"""
     st.write(message.text)
+    render_caption(message)
+
+
+def render_caption(message: Message) -> None:
+    """Отрисовывает подпись сообщения"""
     st.caption(f'{message.name}, {message.ts.strftime("%H:%M:%S")}')
     if message.meta:
         st.caption(message.meta)
@@ -67,6 +121,8 @@ def sidebar():
     """Инициализирует боковую панель с параметрами генерации"""
     with st.sidebar:
         st.selectbox('Модель', options=MODELS.keys(), index=0, key='model_name')
+        for name, load_time in registry.load_times.items():
+            st.caption(f'{name}: загружена за {load_time:.2f}с')
         for param_name, param_spec in GENERATIVE_PARAMS.items():
             st.slider(param_name,
                       min_value=param_spec.min,
@@ -1,28 +1,93 @@
 from abc import ABC, abstractmethod
-from functools import cached_property
-from typing import cast
+from enum import StrEnum
+from threading import Thread
+from typing import Any, Generator, Iterator, cast
 
 import torch
-from transformers import GPT2Tokenizer, GPT2LMHeadModel
+from transformers import GPT2Tokenizer, GPT2LMHeadModel, TextIteratorStreamer
+from transformers.pytorch_utils import Conv1D
+
+from lab02.services.registry import LoadedModel, registry
+
+
+class Backend(StrEnum):
+    """Способ выполнения модели"""
+    FP32 = 'fp32'  # исходные веса
+    INT8 = 'int8'  # динамическое квантование линейных слоев в int8, только CPU
+
+
+def quantize_dynamic(model: GPT2LMHeadModel) -> GPT2LMHeadModel:
+    """
+    Квантует линейные слои модели в int8
+
+    В GPT-2 проекции реализованы слоями Conv1D, которые torch не умеет квантовать, поэтому они сначала заменяются
+    эквивалентными nn.Linear
+    """
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(*child.weight.shape)
+                linear.weight.data = child.weight.data.T.contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
 
 
 class BaseGPTService(ABC):
     """Базовый класс для сервиса GPT-моделей"""
 
+    def __init__(self, backend: Backend = Backend.FP32, num_threads: int | None = None):
+        """
+        Params:
+            backend: Способ выполнения модели.
+            num_threads: Число потоков torch для генерации, по умолчанию не меняется.
+        """
+        self.backend = Backend(backend)
+        self.num_threads = num_threads
+
     @property
     @abstractmethod
     def MODEL_NAME(self) -> str:
         """Название модели"""
 
-    @cached_property
+    @property
+    def name(self) -> str:
+        """Отображаемое название сервиса"""
+        return self.MODEL_NAME if self.backend == Backend.FP32 else f'{self.MODEL_NAME} ({self.backend})'
+
+    @property
+    def loaded(self) -> LoadedModel:
+        """Токенайзер и модель из общего реестра, загружаются при первом обращении"""
+        return registry.get(self.name, self.load)
+
+    @property
+    def is_loaded(self) -> bool:
+        """Загружена ли модель в память"""
+        return registry.is_loaded(self.name)
+
+    @property
     def tokenizer(self) -> GPT2Tokenizer:
         """Токенайзер"""
-        return GPT2Tokenizer.from_pretrained(self.MODEL_NAME)
+        return self.loaded.tokenizer
 
-    @cached_property
+    @property
     def model(self) -> GPT2LMHeadModel:
         """Модель"""
-        return GPT2LMHeadModel.from_pretrained(self.MODEL_NAME)
+        return self.loaded.model
+
+    def load(self) -> tuple[GPT2Tokenizer, GPT2LMHeadModel]:
+        """Загружает токенайзер и модель"""
+        model = GPT2LMHeadModel.from_pretrained(self.MODEL_NAME).eval()
+        if self.backend == Backend.INT8:
+            model = quantize_dynamic(model)
+        return GPT2Tokenizer.from_pretrained(self.MODEL_NAME), model
+
+    def generate(self, input_ids: torch.Tensor, **kwargs: Any) -> Any:
+        """Вызывает model.generate с настройками сервиса"""
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        with torch.inference_mode():
+            return self.model.generate(input_ids, **kwargs)
 
     def send_message(self,
                      text: str,
@@ -44,13 +109,56 @@ class BaseGPTService(ABC):
             repetition_penalty: Штраф за повторение токенов, используемый для снижения вероятности повторов в выходном
                 тексте
         """
+        return ''.join(self.stream_message(text,
+                                           max_length=max_length,
+                                           temperature=temperature,
+                                           top_k=top_k,
+                                           top_p=top_p,
+                                           repetition_penalty=repetition_penalty,
+                                           ))
+
+    def stream_message(self,
+                       text: str,
+                       max_length: int,
+                       temperature: float,
+                       top_k: int,
+                       top_p: float,
+                       repetition_penalty: float,
+                       ) -> Iterator[str]:
+        """
+        То же, что send_message, но возвращает текст по частям по мере генерации токенов. Генерация выполняется в
+        отдельном потоке, параметры совпадают с send_message
+        """
         input_ids = cast(torch.Tensor, self.tokenizer.encode(text, return_tensors='pt'))
-        out = self.model.generate(input_ids,
-                                  do_sample=True,
-                                  max_length=max_length,
-                                  temperature=temperature,
-                                  top_k=top_k,
-                                  top_p=top_p,
-                                  repetition_penalty=repetition_penalty,
-                                  )
-        return '\n'.join(list(map(self.tokenizer.decode, out)))
+        yield from self.stream_generate(TextIteratorStreamer(self.tokenizer),
+                                        input_ids,
+                                        do_sample=True,
+                                        max_length=max_length,
+                                        temperature=temperature,
+                                        top_k=top_k,
+                                        top_p=top_p,
+                                        repetition_penalty=repetition_penalty,
+                                        )
+
+    def stream_generate(self, streamer: TextIteratorStreamer, input_ids: torch.Tensor, **kwargs: Any
+                        ) -> Generator[str, None, Any]:
+        """
+        Запускает model.generate в отдельном потоке и возвращает текст из streamer по мере генерации. Результат
+        generate возвращается как значение генератора (для использования через yield from)
+        """
+        result = {}
+
+        def generate() -> None:
+            try:
+                result['output'] = self.generate(input_ids, streamer=streamer, **kwargs)
+            except Exception as e:
+                result['error'] = e
+                streamer.end()
+
+        thread = Thread(target=generate, daemon=True)
+        thread.start()
+        yield from streamer
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        return result['output']
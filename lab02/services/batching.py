@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import torch
+
+from lab02.services.abc import BaseGPTService
+
+
+@dataclass
+class BatchRequest:
+    """Запрос на генерацию, ожидающий формирования пакета"""
+    text: str
+    params: tuple[tuple[str, float], ...]
+    future: Future = field(default_factory=Future)
+
+
+class GenerationBatcher:
+    """
+    Динамический пакетировщик запросов к GPT-сервису
+
+    Собирает одновременные запросы с одинаковыми параметрами генерации в пакеты до max_batch_size штук, ожидая
+    очередной пакет не дольше max_wait секунд после прихода первого запроса в нем. Внутри пакета запросы группируются
+    по длине промпта: в один вызов generate попадают промпты, различающиеся не больше чем на bucket_width токенов и
+    вместе помещающиеся в контекст модели. Результат для каждого запроса совпадает по формату с
+    BaseGPTService.send_message
+    """
+
+    def __init__(self, service: BaseGPTService, max_batch_size: int = 8, max_wait: float = 0.05,
+                 bucket_width: int = 64):
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.bucket_width = bucket_width
+        self._queue: queue.Queue[BatchRequest] = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name=f'batcher-{service.name}', daemon=True)
+        self._worker.start()
+
+    def send_message(self,
+                     text: str,
+                     max_length: int,
+                     temperature: float,
+                     top_k: int,
+                     top_p: float,
+                     repetition_penalty: float,
+                     ) -> str:
+        """Ставит запрос в очередь и ждет результата, параметры совпадают с BaseGPTService.send_message"""
+        params = dict(max_length=max_length, temperature=temperature, top_k=top_k, top_p=top_p,
+                      repetition_penalty=repetition_penalty)
+        request = BatchRequest(text, tuple(sorted(params.items())))
+        self._queue.put(request)
+        return request.future.result()
+
+    def _run(self) -> None:
+        groups: dict[tuple, list[BatchRequest]] = {}
+        deadlines: dict[tuple, float] = {}
+        while True:
+            timeout = max(0.0, min(deadlines.values()) - time.monotonic()) if deadlines else None
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                groups.setdefault(request.params, []).append(request)
+                deadlines.setdefault(request.params, time.monotonic() + self.max_wait)
+
+            now = time.monotonic()
+            for params in [params for params, group in groups.items()
+                           if len(group) >= self.max_batch_size or deadlines[params] <= now]:
+                batch = groups.pop(params)
+                del deadlines[params]
+                self._generate(batch[:self.max_batch_size], dict(params))
+                if batch[self.max_batch_size:]:
+                    groups[params] = batch[self.max_batch_size:]
+                    deadlines[params] = now
+
+    def _generate(self, batch: list[BatchRequest], params: dict) -> None:
+        try:
+            encoded = [self.service.tokenizer.encode(request.text) for request in batch]
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        for bucket in self._split(encoded, params['max_length']):
+            try:
+                texts = self._generate_texts([encoded[i] for i in bucket], **params)
+            except Exception as e:
+                for i in bucket:
+                    batch[i].future.set_exception(e)
+            else:
+                for i, text in zip(bucket, texts):
+                    batch[i].future.set_result(text)
+
+    def _context_size(self) -> int | None:
+        config = self.service.model.config
+        return getattr(config, 'n_positions', None) or getattr(config, 'max_position_embeddings', None)
+
+    def _split(self, encoded: list[list[int]], max_length: int) -> list[list[int]]:
+        """
+        Разбивает запросы на группы близкой длины и возвращает индексы запросов каждой группы
+
+        Пакет генерирует max_length минус длина самого короткого промпта новых токенов после самого длинного, поэтому
+        группа должна помещаться в контекст модели целиком, даже если каждый запрос по отдельности в него помещается
+        """
+        limit = self._context_size()
+        buckets = []
+        for i in sorted(range(len(encoded)), key=lambda i: len(encoded[i])):
+            if buckets:
+                shortest, longest = len(encoded[buckets[-1][0]]), len(encoded[i])
+                fits = limit is None or longest + max_length - shortest <= limit
+                if fits and longest - shortest <= self.bucket_width:
+                    buckets[-1].append(i)
+                    continue
+            buckets.append([i])
+        return buckets
+
+    def _generate_texts(self, encoded: list[list[int]], max_length: int, **params) -> list[str]:
+        tokenizer = self.service.tokenizer
+        eos_id = tokenizer.eos_token_id
+        width = max(map(len, encoded))
+        max_new_tokens = max_length - min(map(len, encoded))
+        if (limit := self._context_size()) is not None:
+            max_new_tokens = min(max_new_tokens, limit - width)
+        # Выравниваем запросы по правому краю, чтобы генерация для всех продолжалась с последнего токена
+        input_ids = torch.tensor([[eos_id] * (width - len(ids)) + ids for ids in encoded])
+        attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in encoded])
+        out = self.service.generate(input_ids,
+                                    attention_mask=attention_mask,
+                                    pad_token_id=eos_id,
+                                    do_sample=True,
+                                    max_new_tokens=max(1, max_new_tokens),
+                                    **params,
+                                    )
+
+        results = []
+        for ids, row in zip(encoded, out.tolist()):
+            # Каждому запросу оставляем столько новых токенов, сколько он получил бы при генерации в одиночку
+            generated = row[width:width + max(0, max_length - len(ids))]
+            if eos_id in generated:
+                generated = generated[:generated.index(eos_id) + 1]
+            results.append(tokenizer.decode(ids + generated))
+        return results
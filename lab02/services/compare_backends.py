@@ -0,0 +1,101 @@
+"""
+Сравнение способов выполнения модели (fp32 и int8) по скорости, памяти и отклонению результатов
+
+Каждый способ измеряется в отдельном процессе, чтобы пиковое потребление памяти не смешивалось. Пример запуска:
+    python -m lab02.services.compare_backends sberbank-ai/rugpt3medium_based_on_gpt2 --threads 4
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from lab02.services.abc import Backend, BaseGPTService
+from lab02.services.const import MODELS, BASE_TEXT
+
+PROMPTS = [
+    BASE_TEXT,
+    'Александр Сергеевич Пушкин родился в',
+    'Машинное обучение - это',
+]
+
+
+def measure(service_cls: type[BaseGPTService], backend: Backend, num_threads: int | None, new_tokens: int) -> dict:
+    """Измеряет скорость генерации и память для одного способа выполнения, вызывается в отдельном процессе"""
+    service = service_cls(backend=backend, num_threads=num_threads)
+    start = time.monotonic()
+    tokenizer, model = service.tokenizer, service.model
+    load_time = time.monotonic() - start
+
+    logits, outputs, generation_time = [], [], 0.0
+    for prompt in PROMPTS:
+        input_ids = tokenizer.encode(prompt, return_tensors='pt')
+        with torch.inference_mode():
+            logits.append(model(input_ids).logits[0, -1])
+        start = time.monotonic()
+        out = service.generate(input_ids,
+                               attention_mask=torch.ones_like(input_ids),
+                               pad_token_id=tokenizer.eos_token_id,
+                               do_sample=False,
+                               min_new_tokens=new_tokens,
+                               max_new_tokens=new_tokens,
+                               )
+        generation_time += time.monotonic() - start
+        outputs.append(out[0, input_ids.shape[1]:].tolist())
+
+    return {
+        'load_time': load_time,
+        'tokens_per_sec': new_tokens * len(PROMPTS) / generation_time,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'logits': logits,
+        'outputs': outputs,
+    }
+
+
+def drift(baseline: dict, result: dict) -> dict:
+    """Отклонение результатов от эталонного способа выполнения"""
+    logits_diff = max((a - b).abs().max().item() for a, b in zip(baseline['logits'], result['logits']))
+    top1 = sum(bool(a.argmax() == b.argmax()) for a, b in zip(baseline['logits'], result['logits']))
+    matched = total = 0
+    for a, b in zip(baseline['outputs'], result['outputs']):
+        total += len(a)
+        matched += next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+    return {
+        'max_logits_diff': logits_diff,
+        'top1_agreement': top1 / len(baseline['logits']),
+        'greedy_prefix_agreement': matched / total,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение fp32 и int8 выполнения модели')
+    parser.add_argument('model', choices=[name for name, model in MODELS.items() if model.backend == Backend.FP32])
+    parser.add_argument('--threads', type=int, default=None, help='Число потоков torch')
+    parser.add_argument('--new-tokens', type=int, default=50, help='Сколько токенов генерировать на каждый промпт')
+    args = parser.parse_args()
+
+    service_cls = type(MODELS[args.model])
+    results = {}
+    for backend in Backend:
+        # Новый процесс на каждый способ, чтобы пиковая память измерялась независимо
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results[backend] = executor.submit(measure, service_cls, backend, args.threads, args.new_tokens).result()
+
+    baseline = results[Backend.FP32]
+    report = {
+        backend: {
+            'load_time': result['load_time'],
+            'tokens_per_sec': result['tokens_per_sec'],
+            'peak_rss_mb': result['peak_rss_mb'],
+            **(drift(baseline, result) if backend != Backend.FP32 else {}),
+        }
+        for backend, result in results.items()
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,13 @@
 from dataclasses import dataclass
 from typing import Generic, TypeVar
 
+from lab02.services.abc import Backend
 from lab02.services.sberdevices import SberDevicesRuGPT3Small, SberDevicesRuGPT3Medium
 
-MODELS = {model.MODEL_NAME: model for model in (
+MODELS = {model.name: model for model in (
     SberDevicesRuGPT3Small(),
     SberDevicesRuGPT3Medium(),
+    SberDevicesRuGPT3Medium(backend=Backend.INT8),
 )}
 
 
@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable
+
+import torch
+
+
+@dataclass
+class LoadedModel:
+    """Загруженные в память токенайзер и модель"""
+    tokenizer: Any
+    model: Any
+    size: int  # размер весов модели в байтах
+    load_time: float  # время загрузки в секундах
+
+
+def model_size(model: Any) -> int:
+    """
+    Размер весов модели в байтах
+
+    Считается по state_dict(), а не по parameters(): у динамически квантованных слоев веса упакованы и в параметры не
+    входят. Общие для нескольких слоев тензоры учитываются один раз
+    """
+    seen, size = set(), 0
+    values = list(model.state_dict().values())
+    while values:
+        value = values.pop()
+        if isinstance(value, (tuple, list)):
+            values.extend(value)
+        elif isinstance(value, torch.Tensor) and value.data_ptr() not in seen:
+            seen.add(value.data_ptr())
+            size += value.numel() * value.element_size()
+    return size
+
+
+class ModelRegistry:
+    """
+    Общий для процесса реестр загруженных моделей
+
+    Переживает перезапуски скрипта streamlit и разделяется между всеми сессиями. Если задан memory_budget (в байтах), то
+    при превышении бюджета выгружаются давно не использованные модели
+    """
+
+    def __init__(self, memory_budget: int | None = None):
+        self.memory_budget = memory_budget
+        self.load_times: dict[str, float] = {}
+        self._models: OrderedDict[str, LoadedModel] = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks: dict[str, threading.Lock] = {}
+
+    def is_loaded(self, key: str) -> bool:
+        """Загружена ли модель"""
+        return key in self._models
+
+    def get(self, key: str, load: Callable[[], tuple[Any, Any]]) -> LoadedModel:
+        """Возвращает модель по ключу, при необходимости загружая ее через load() -> (tokenizer, model)"""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # Одну и ту же модель загружаем один раз, даже если она одновременно нужна нескольким сессиям
+        with key_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+
+            start = time.monotonic()
+            tokenizer, model = load()
+            loaded = LoadedModel(tokenizer, model, model_size(model), time.monotonic() - start)
+
+            with self._lock:
+                self.load_times[key] = loaded.load_time
+                self._models[key] = loaded
+                self._evict()
+            return loaded
+
+    def _evict(self) -> None:
+        if self.memory_budget is None:
+            return
+        while len(self._models) > 1 and sum(loaded.size for loaded in self._models.values()) > self.memory_budget:
+            self._models.popitem(last=False)
+
+    def warm_up(self, services: Iterable[Any]) -> threading.Thread:
+        """Загружает модели сервисов в фоновом потоке"""
+        def load_all() -> None:
+            for service in services:
+                service.model
+
+        thread = threading.Thread(target=load_all, name='models-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+
+budget_mb = os.getenv('LAB02_MODEL_MEMORY_BUDGET_MB')
+registry = ModelRegistry(memory_budget=int(budget_mb) * 1024 * 1024 if budget_mb else None)
@@ -0,0 +1,74 @@
+from typing import Iterator
+
+import torch
+from transformers import TextIteratorStreamer
+
+from lab02.services.abc import BaseGPTService
+
+
+class ChatSession:
+    """
+    Диалог с GPT-моделью, сохраняющий токены истории и KV-кэш модели между репликами
+
+    Каждая новая реплика дописывается к истории, и модель вычисляет представления только для новых токенов. Если история
+    вместе с новой репликой не помещается в max_context токенов, старая часть истории отбрасывается, а кэш строится
+    заново по оставшейся
+    """
+
+    def __init__(self, service: BaseGPTService, max_context: int | None = None):
+        self.service = service
+        n_positions = service.model.config.n_positions
+        self.max_context = min(max_context or n_positions, n_positions)
+        self.input_ids = torch.empty((1, 0), dtype=torch.long)
+        self.past_key_values = None
+
+    def reset(self) -> None:
+        """Очищает историю диалога"""
+        self.input_ids = torch.empty((1, 0), dtype=torch.long)
+        self.past_key_values = None
+
+    def _truncate(self, keep: int) -> None:
+        """Оставляет не более keep последних токенов истории"""
+        # Кэш нельзя обрезать слева из-за абсолютных позиционных эмбеддингов, поэтому он строится заново.
+        # Оставляем не больше половины контекста, чтобы пересчет происходил не на каждой реплике
+        keep = min(keep, self.max_context // 2)
+        if keep <= 0:
+            return self.reset()
+        self.input_ids = self.input_ids[:, -keep:]
+        self.past_key_values = None
+
+    def stream_message(self,
+                       text: str,
+                       max_length: int,
+                       temperature: float,
+                       top_k: int,
+                       top_p: float,
+                       repetition_penalty: float,
+                       ) -> Iterator[str]:
+        """
+        Продолжает диалог репликой text и возвращает ее вместе с ответом модели по мере генерации
+
+        Параметры совпадают с BaseGPTService.send_message, max_length ограничивает длину реплики вместе с ответом
+        """
+        tokenizer = self.service.tokenizer
+        new_ids = tokenizer.encode(text, return_tensors='pt')
+        max_new_tokens = max(1, max_length - new_ids.shape[1])
+        if self.input_ids.shape[1] + new_ids.shape[1] + max_new_tokens > self.max_context:
+            self._truncate(self.max_context - new_ids.shape[1] - max_new_tokens)
+        input_ids = torch.cat([self.input_ids, new_ids], dim=1)
+
+        yield text
+        output = yield from self.service.stream_generate(TextIteratorStreamer(tokenizer, skip_prompt=True),
+                                                         input_ids,
+                                                         attention_mask=torch.ones_like(input_ids),
+                                                         past_key_values=self.past_key_values,
+                                                         do_sample=True,
+                                                         max_new_tokens=max_new_tokens,
+                                                         temperature=temperature,
+                                                         top_k=top_k,
+                                                         top_p=top_p,
+                                                         repetition_penalty=repetition_penalty,
+                                                         return_dict_in_generate=True,
+                                                         )
+        self.input_ids = output.sequences
+        self.past_key_values = output.past_key_values
@@ -0,0 +1,290 @@
+"""
+Нагрузочный тест бота без Telegram и настоящих LLM
+
+Запускает в отдельном процессе aiohttp-заглушку, которая отвечает в форматах VseGpt и Yandex Foundation Models с
+заданной задержкой и долей ошибок, направляет на нее клиентов из AVAILABLE_SERVICES и прогоняет через router N
+виртуальных пользователей, каждый из которых проходит всю форму Form и затем несколько раз просит подобрать еще раз.
+Запросы к Telegram API перехватываются фиктивной сессией бота. Измеряются сообщения в секунду, p50/p99 времени
+обработчиков и задержка цикла событий. Пример запуска:
+    python -m lab04.benchmark --users 200 --latency 0.5 --error-rate 0.05 --output bench.json
+    python -m lab04.benchmark --users 200 --latency 0.5 --baseline bench.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import statistics
+import sys
+from datetime import datetime
+from itertools import count
+from time import monotonic
+from typing import Any, AsyncGenerator
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import SendMessage, TelegramMethod
+from aiogram.types import Chat, Message, Update, User
+from aiohttp import web
+
+from lab04.bot import locals
+from lab04.bot.handlers import Form, router
+from lab04.bot.service import AVAILABLE_SERVICES
+from lab04.lib.client.vsegpt import VsegptClient
+from lab04.lib.client.yandex import YandexFoundationModelsClient
+
+UPDATE_IDS = count(1)
+
+ANSWER = 'Toyota Camry 🚗 надежный седан для города и трассы. Skoda Octavia 🚙 просторная и экономичная. ' * 5
+
+
+def stub_app(latency: float, jitter: float, error_rate: float, chunks: int) -> web.Application:
+    """
+    Заглушка LLM-провайдеров
+
+    Ответ приходит через latency ± jitter секунд частями по chunks штук, с вероятностью error_rate вместо него
+    возвращается 503, который клиенты повторяют
+    """
+
+    async def delay() -> None:
+        await asyncio.sleep(max(0.0, random.uniform(latency - jitter, latency + jitter)))
+
+    def parts() -> list[str]:
+        step = len(ANSWER) // chunks + 1
+        return [ANSWER[i:i + step] for i in range(0, len(ANSWER), step)]
+
+    async def vsegpt(request: web.Request) -> web.StreamResponse:
+        data = await request.json()
+        await delay()
+        if random.random() < error_rate:
+            return web.Response(status=503)
+        if not data.get('stream'):
+            return web.json_response({'choices': [{'message': {'content': ANSWER}}]})
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for part in parts():
+            chunk = json.dumps({'choices': [{'delta': {'content': part}}]}, ensure_ascii=False)
+            await response.write(f'data: {chunk}\n\n'.encode())
+            await asyncio.sleep(latency / chunks)
+        await response.write(b'data: [DONE]\n\n')
+        return response
+
+    async def yandex(request: web.Request) -> web.StreamResponse:
+        data = await request.json()
+        await delay()
+        if random.random() < error_rate:
+            return web.Response(status=503)
+        if not data['completionOptions'].get('stream'):
+            return web.json_response({'result': {'alternatives': [{'message': {'text': ANSWER}}]}})
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        text = ''
+        for part in parts():
+            text += part
+            chunk = json.dumps({'result': {'alternatives': [{'message': {'text': text}}]}}, ensure_ascii=False)
+            await response.write(f'{chunk}\n'.encode())
+            await asyncio.sleep(latency / chunks)
+        return response
+
+    app = web.Application()
+    app.router.add_post('/vsegpt', vsegpt)
+    app.router.add_post('/yandex', yandex)
+    return app
+
+
+def run_stub(port: int, latency: float, jitter: float, error_rate: float, chunks: int) -> None:
+    web.run_app(stub_app(latency, jitter, error_rate, chunks), host='127.0.0.1', port=port, print=None)
+
+
+class FakeSession(BaseSession):
+    """Сессия бота, которая не ходит в Telegram, а сразу отвечает на запросы с задержкой latency"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.requests = 0
+        self._message_ids = count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None) -> Any:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if isinstance(method, SendMessage):
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type='private'),
+                text=method.text,
+            ).as_(bot)
+        return True
+
+    async def stream_content(self, url: str, headers: dict | None = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b''
+
+    async def close(self) -> None:
+        pass
+
+
+def user_script(user_id: int, rounds: int) -> list[str]:
+    """Сообщения виртуального пользователя: вся форма, затем rounds повторных подборов в обход кэша"""
+    return [
+        '/start',
+        locals.START_BUTTON,
+        f'до {user_id % 10 + 1} млн рублей',
+        random.choice(['седан', 'внедорожник', 'электромобиль']),
+        random.choice(['повседневные поездки', 'дальние путешествия', 'не важно']),
+        f'безопасность, вариант {user_id}',
+        random.choice(list(locals.Condition)),
+        '-',
+        *[locals.GENERATE_AGAIN_BUTTON] * rounds,
+    ]
+
+
+async def virtual_user(dp: Dispatcher, bot: Bot, user_id: int, rounds: int, think_time: float,
+                       latencies: dict[str, list[float]]) -> None:
+    user = User(id=user_id, is_bot=False, first_name=f'user{user_id}')
+    chat = Chat(id=user_id, type='private')
+    for message_id, text in enumerate(user_script(user_id, rounds), 1):
+        await asyncio.sleep(random.uniform(0, 2 * think_time))
+        message = Message(message_id=message_id, date=datetime.now(), chat=chat, from_user=user, text=text)
+        # Ответы LLM приходят в состоянии models и result, их учитываем отдельно от быстрых шагов формы
+        state = await dp.fsm.get_context(bot, chat.id, user_id).get_state()
+        kind = 'llm' if state in (Form.models.state, Form.result.state) else 'form'
+        start = monotonic()
+        # update_id должны быть разными: aiogram кэширует тип обновления по хэшу, который от него зависит
+        await dp.feed_update(bot, Update(update_id=next(UPDATE_IDS), message=message))
+        latencies[kind].append(monotonic() - start)
+
+
+async def monitor_loop_lag(interval: float, lags: list[float]) -> None:
+    """Замеряет, насколько позже положенного просыпается корутина, — это время, когда цикл событий был занят"""
+    while True:
+        start = monotonic()
+        await asyncio.sleep(interval)
+        lags.append(monotonic() - start - interval)
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+async def wait_for_stub(port: int, timeout: float = 10) -> None:
+    deadline = monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    await wait_for_stub(args.port)
+    for service in AVAILABLE_SERVICES:
+        # Заголовки собираются из токенов, которых без окружения бота нет
+        service.client.token = 'benchmark'
+        if isinstance(service.client, VsegptClient):
+            service.client.URL = f'http://127.0.0.1:{args.port}/vsegpt'
+        elif isinstance(service.client, YandexFoundationModelsClient):
+            service.client.URL = f'http://127.0.0.1:{args.port}/yandex'
+            service.client.folder = 'benchmark'
+        await service.client.start()
+
+    session = FakeSession(args.telegram_latency)
+    bot = Bot(token='0:benchmark', session=session)
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(router)
+
+    latencies = {'form': [], 'llm': []}
+    lags = []
+    monitor = asyncio.create_task(monitor_loop_lag(args.lag_interval, lags))
+    start = monotonic()
+    try:
+        await asyncio.gather(*(
+            virtual_user(dp, bot, user_id, args.rounds, args.think_time, latencies)
+            for user_id in range(1, args.users + 1)
+        ))
+    finally:
+        elapsed = monotonic() - start
+        monitor.cancel()
+        await asyncio.gather(*(service.client.close() for service in AVAILABLE_SERVICES))
+
+    messages = len(latencies['form']) + len(latencies['llm'])
+    return {
+        'users': args.users,
+        'messages': messages,
+        'elapsed': elapsed,
+        'messages_per_sec': messages / elapsed,
+        'telegram_requests': session.requests,
+        'form_latency_p50': percentile(latencies['form'], 50),
+        'form_latency_p99': percentile(latencies['form'], 99),
+        'llm_latency_p50': percentile(latencies['llm'], 50),
+        'llm_latency_p99': percentile(latencies['llm'], 99),
+        'loop_lag_p99': percentile(lags, 99),
+        'loop_lag_max': max(lags, default=0.0),
+    }
+
+
+def find_regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Сравнивает результаты с сохраненными и возвращает описания ухудшений больше чем на tolerance"""
+    regressions = []
+    if result['messages_per_sec'] < baseline['messages_per_sec'] * (1 - tolerance):
+        regressions.append(f"messages_per_sec {baseline['messages_per_sec']:.2f} -> {result['messages_per_sec']:.2f}")
+    for metric in ('form_latency_p99', 'llm_latency_p99', 'loop_lag_p99'):
+        if result[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append(f'{metric} {baseline[metric]:.4f} -> {result[metric]:.4f}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота с заглушкой LLM')
+    parser.add_argument('--users', type=int, default=100, help='Число виртуальных пользователей')
+    parser.add_argument('--rounds', type=int, default=2, help='Сколько раз каждый пользователь подбирает заново')
+    parser.add_argument('--think-time', type=float, default=0.1, help='Средняя пауза между сообщениями, с')
+    parser.add_argument('--latency', type=float, default=0.5, help='Задержка ответа заглушки LLM, с')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Разброс задержки заглушки LLM, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов заглушки с ошибкой 503')
+    parser.add_argument('--chunks', type=int, default=10, help='Число частей потокового ответа заглушки')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='Задержка фиктивного Telegram API, с')
+    parser.add_argument('--lag-interval', type=float, default=0.01, help='Период замера задержки цикла событий, с')
+    parser.add_argument('--port', type=int, default=8765, help='Порт заглушки LLM')
+    parser.add_argument('--output', default=None, help='Файл .json для результатов, по умолчанию stdout')
+    parser.add_argument('--baseline', default=None, help='Сохраненные результаты (.json) для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Допустимое относительное ухудшение метрик')
+    args = parser.parse_args()
+
+    # Заглушка работает в своем процессе, чтобы ее нагрузка не попадала в замеры цикла событий бота
+    stub = multiprocessing.get_context('spawn').Process(
+        target=run_stub, args=(args.port, args.latency, args.jitter, args.error_rate, args.chunks), daemon=True,
+    )
+    stub.start()
+    try:
+        result = asyncio.run(run_benchmark(args))
+    finally:
+        stub.terminate()
+        stub.join()
+
+    data = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output is None:
+        print(data)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(data)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = find_regressions(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'[Регрессия] {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,117 @@
+import asyncio
 import os
+from pathlib import Path
+
 from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from lab04.bot.handlers import router, IN_FLIGHT_TASKS
+from lab04.bot.service import AVAILABLE_SERVICES
+from lab04.lib.metrics import REGISTRY
+from lab04.lib.storage import SQLiteStorage
+
+# Сколько секунд при остановке ждать завершения запросов к LLM
+SHUTDOWN_TIMEOUT = float(os.getenv('BOT_SHUTDOWN_TIMEOUT', 60))
 
-from lab04.bot.handlers import router
+# Порт HTTP-эндпоинта /metrics в режиме polling; в режиме вебхука он добавляется к серверу вебхука
+METRICS_PORT = os.getenv('METRICS_PORT')
+# Файл, в который раз в METRICS_DUMP_INTERVAL секунд сохраняются метрики в JSON
+METRICS_DUMP_PATH = os.getenv('METRICS_DUMP_PATH')
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', 60))
+
+
+def make_storage() -> BaseStorage:
+    """Хранилище состояний FSM: SQLite-файл из FSM_STORAGE_PATH, общий для процессов, или память процесса"""
+    path = os.getenv('FSM_STORAGE_PATH')
+    if path is None:
+        return MemoryStorage()
+    return SQLiteStorage(path, ttl=float(os.getenv('FSM_STORAGE_TTL', 7 * 24 * 60 * 60)))
 
 
 bot = Bot(token=os.getenv('BOT_TOKEN'))
-dp = Dispatcher()
+dp = Dispatcher(storage=make_storage())
 dp.include_router(router)
 
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Отдает метрики в текстовом формате Prometheus"""
+    return web.Response(text=REGISTRY.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+
+async def dump_metrics(path: Path) -> None:
+    """Периодически перезаписывает файл с метриками в JSON"""
+    while True:
+        await asyncio.sleep(METRICS_DUMP_INTERVAL)
+        tmp = path.with_suffix(path.suffix + '.tmp')
+        tmp.write_text(REGISTRY.dump_json(), encoding='utf-8')
+        tmp.replace(path)
+
+
+async def serve_metrics(port: int) -> None:
+    """Отдельный сервер с эндпоинтом /metrics для режима polling"""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port, reuse_port=True).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def on_startup() -> None:
+    """Открывает пулы соединений к LLM до начала обработки обновлений"""
+    await asyncio.gather(*(service.client.start() for service in AVAILABLE_SERVICES))
+    if METRICS_DUMP_PATH:
+        _background_tasks.add(asyncio.create_task(dump_metrics(Path(f'{METRICS_DUMP_PATH}.{os.getpid()}'))))
+
+
+async def on_shutdown() -> None:
+    """Дожидается выполняющихся запросов к LLM и закрывает пулы соединений и хранилище состояний"""
+    if IN_FLIGHT_TASKS:
+        await asyncio.wait(IN_FLIGHT_TASKS, timeout=SHUTDOWN_TIMEOUT)
+    await asyncio.gather(*(service.client.close() for service in AVAILABLE_SERVICES))
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    # Dispatcher закрывает хранилище раньше этого обработчика, поэтому записи дожидавшихся запросов
+    # сбрасываются повторным закрытием
+    await dp.storage.close()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
 async def run_bot():
+    if METRICS_PORT:
+        _background_tasks.add(asyncio.create_task(serve_metrics(int(METRICS_PORT))))
     await dp.start_polling(bot)
+
+
+async def set_webhook(url: str, secret: str | None) -> None:
+    """Регистрирует вебхук в Telegram"""
+    await bot.set_webhook(url, secret_token=secret)
+    # Сессия привязана к текущему циклу событий, процессы-воркеры откроют свою
+    await bot.session.close()
+
+
+def run_webhook(host: str, port: int, path: str, secret: str | None = None) -> None:
+    """
+    Запускает бота в режиме вебхука на aiohttp-сервере
+
+    Сокет открывается с SO_REUSEPORT, поэтому несколько процессов могут слушать один порт за обратным прокси. Запросы
+    с неверным секретом (заголовок X-Telegram-Bot-Api-Secret-Token) отклоняются. Метрики процесса доступны по /metrics
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=host, port=port, reuse_port=True, shutdown_timeout=SHUTDOWN_TIMEOUT, print=None)
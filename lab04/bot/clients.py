@@ -1,3 +1,5 @@
+import os
+
 from lab04.lib.client.vsegpt import VsegptClient
 from lab04.lib.client.yandex import YandexFoundationModelsClient
 
@@ -7,6 +9,8 @@ class LlamaClient(YandexFoundationModelsClient):
 
     name = 'LLaMa 3.1 8B'
     model = 'llama-lite/latest'
+    TIMEOUT = float(os.getenv('YC_TIMEOUT', 60))
+    HEDGE = os.getenv('LLM_HEDGING') == '1'
 
 
 class GPTClient(VsegptClient):
@@ -14,3 +18,5 @@ class GPTClient(VsegptClient):
 
     name = 'GPT-4o mini'
     model = 'openai/gpt-4o-mini'
+    TIMEOUT = float(os.getenv('VSEGPT_TIMEOUT', 60))
+    HEDGE = os.getenv('LLM_HEDGING') == '1'
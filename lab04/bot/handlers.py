@@ -1,18 +1,53 @@
 import asyncio
+import logging
+import os
 from time import monotonic
+from typing import Any, Awaitable, Callable
 
 from aiogram import Router
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, ReplyKeyboardRemove
+from aiogram.types import Message, ReplyKeyboardRemove, TelegramObject
 
 from lab04.bot import locals
 from lab04.bot.keyboards import START_KEYBOARD, ASK_CONDITION_KEYBOARD, RESULT_KEYBOARD
 from lab04.bot.service import LlmService, AVAILABLE_SERVICES
+from lab04.lib.metrics import REGISTRY, SIZE_BUCKETS
+from lab04.lib.scheduler import QueueFullError, UserTasks
 
 router = Router(name=__name__)
 
+HANDLER_SECONDS = REGISTRY.histogram('bot_handler_seconds', 'Время обработки сообщения по состоянию FSM')
+MESSAGE_BYTES = REGISTRY.histogram('bot_message_bytes', 'Размер текста входящего сообщения', SIZE_BUCKETS)
+
+logger = logging.getLogger(__name__)
+
+# Если больше нуля, ответ отправляется только от FASTEST_N первых ответивших моделей, остальные запросы отменяются
+FASTEST_N = int(os.getenv('LLM_FASTEST_N', 0))
+
+# Задачи, ожидающие ответа от LLM, — при остановке бота даем им завершиться
+IN_FLIGHT_TASKS: set[asyncio.Task] = set()
+# Повторный запрос пользователя отменяет его предыдущий, еще не завершенный
+USER_TASKS = UserTasks()
+
+EDIT_INTERVAL = 1.5  # минимальный интервал между редактированиями сообщения, чтобы не упираться в лимиты Telegram
+MESSAGE_MAX_LENGTH = 4096
+
+
+@router.message.outer_middleware()
+async def metrics_middleware(
+    handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]], message: Message, data: dict[str, Any],
+) -> Any:
+    """Замеряет время обработчика и размер сообщения с разбивкой по состоянию FSM, в котором оно пришло"""
+    state = data.get('raw_state') or 'none'
+    MESSAGE_BYTES.observe(len((message.text or '').encode()), state=state)
+    start = monotonic()
+    try:
+        return await handler(message, data)
+    finally:
+        HANDLER_SECONDS.observe(monotonic() - start, state=state)
+
 
 class Form(StatesGroup):
     """Класс, описывающий состояния системы FSM"""
@@ -88,7 +123,7 @@ async def features_state_handler(message: Message, state: FSMContext) -> None:
 @router.message(Form.condition)
 async def condition_state_handler(message: Message, state: FSMContext) -> None:
     """Обработчик состояния condition"""
-    if message.text in locals.Condition:
+    if message.text in list(locals.Condition):
         await state.update_data(condition=locals.Condition(message.text))
         await state.set_state(Form.models)
         await message.answer(locals.ASK_MODELS)
@@ -103,24 +138,84 @@ async def models_state_handler(message: Message, state: FSMContext) -> None:
     await to_result(message, state)
 
 
-async def to_result(message: Message, state: FSMContext) -> None:
+async def to_result(message: Message, state: FSMContext, use_cache: bool = True) -> None:
     """Генерирует результат"""
-    tasks = [
-        asyncio.create_task(make_request_and_send_message(message, state, service))
+    task = asyncio.current_task()
+    IN_FLIGHT_TASKS.add(task)
+    USER_TASKS.replace((message.chat.id, message.from_user.id), task)
+    try:
+        await state.set_state(Form.result)
+        if 0 < FASTEST_N < len(AVAILABLE_SERVICES):
+            return await to_fastest_result(message, state, use_cache)
+        tasks = [
+            asyncio.create_task(make_request_and_send_message(message, state, service, use_cache))
+            for service in AVAILABLE_SERVICES
+        ]
+        await asyncio.gather(*tasks)
+    finally:
+        IN_FLIGHT_TASKS.discard(task)
+
+
+async def to_fastest_result(message: Message, state: FSMContext, use_cache: bool = True) -> None:
+    """Отправляет ответы FASTEST_N первых успешно ответивших моделей и отменяет запросы к остальным"""
+    data = await state.get_data()
+    start = monotonic()
+    tasks = {
+        asyncio.create_task(service.search_vehicles(**data, use_cache=use_cache)): service
         for service in AVAILABLE_SERVICES
-    ]
-    await state.set_state(Form.result)
-    await asyncio.gather(*tasks)
-
-
-async def make_request_and_send_message(message: Message, state: FSMContext, service: LlmService) -> None:
+    }
+    pending, answered = set(tasks), 0
+    try:
+        while pending and answered < FASTEST_N:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                service = tasks[task]
+                if isinstance(task.exception(), QueueFullError):
+                    await message.answer(locals.PROVIDER_BUSY.format(name=service.client.name))
+                    continue
+                if task.exception() is not None:
+                    logger.warning('Запрос к %s завершился ошибкой', service.client.name, exc_info=task.exception())
+                    continue
+                answered += 1
+                await message.answer(
+                    f'Ответ от {service.client.name}, {monotonic() - start:.2f}с:\n\n{task.result()}',
+                    reply_markup=RESULT_KEYBOARD,
+                )
+        if not answered:
+            await message.answer(locals.REQUEST_ERROR.format(name='моделей'), reply_markup=RESULT_KEYBOARD)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def make_request_and_send_message(
+    message: Message, state: FSMContext, service: LlmService, use_cache: bool = True,
+) -> None:
     """Генерирует ответ через service, обогащает мета-информацией и отправляет пользователю"""
     data = await state.get_data()
     start = monotonic()
-    result = await service.search_vehicles(**data)
-    await message.answer(
-        f'Ответ от {service.client.name}, {monotonic() - start:.2f}с:\n\n{result}',
-        reply_markup=RESULT_KEYBOARD,
+    # Сразу отправляем заглушку и дописываем в нее ответ по мере генерации
+    answer = await message.answer(locals.GENERATING.format(name=service.client.name), reply_markup=RESULT_KEYBOARD)
+    last_edit = monotonic()
+    result = ''
+    try:
+        async with asyncio.timeout(service.client.TIMEOUT):
+            async for result in service.stream_vehicles(**data, use_cache=use_cache):
+                if monotonic() - last_edit >= EDIT_INTERVAL:
+                    await answer.edit_text(f'Ответ от {service.client.name}:\n\n{result}'[:MESSAGE_MAX_LENGTH])
+                    last_edit = monotonic()
+    except asyncio.CancelledError:
+        await answer.edit_text(locals.CANCELLED.format(name=service.client.name))
+        raise
+    except QueueFullError:
+        await answer.edit_text(locals.PROVIDER_BUSY.format(name=service.client.name))
+        return
+    except Exception:
+        logger.exception('Запрос к %s завершился ошибкой', service.client.name)
+        await answer.edit_text(locals.REQUEST_ERROR.format(name=service.client.name))
+        return
+    await answer.edit_text(
+        f'Ответ от {service.client.name}, {monotonic() - start:.2f}с:\n\n{result}'[:MESSAGE_MAX_LENGTH],
     )
 
 
@@ -129,7 +224,8 @@ async def result_state_handler(message: Message, state: FSMContext) -> None:
     """Обработчик состояния result"""
     match message.text:
         case locals.GENERATE_AGAIN_BUTTON:
-            await to_result(message, state)
+            # Пользователь явно просит новый вариант, поэтому кэш не используем
+            await to_result(message, state, use_cache=False)
         case locals.TRY_AGAIN_BUTTON:
             await to_budget(message, state)
         case locals.START_AGAIN_BUTTON:
@@ -45,6 +45,11 @@ class Condition(StrEnum):
 
 ASK_MODELS = 'Есть ли предпочтения по марке или модели? 🏷️🚙'
 
+GENERATING = 'Ответ от {name}: генерирую... ⏳'
+PROVIDER_BUSY = '{name} сейчас перегружена запросами 🚦 Попробуй еще раз через минуту'
+CANCELLED = 'Ответ от {name} отменен: подбираю заново 🔄'
+REQUEST_ERROR = 'Не удалось получить ответ от {name} 😔 Попробуй еще раз чуть позже'
+
 GENERATE_AGAIN_BUTTON = 'Подобрать еще раз 🔄'
 TRY_AGAIN_BUTTON = 'Подобрать другое авто ⚙️'
 START_AGAIN_BUTTON = 'В начало ⏪'
@@ -1,8 +1,12 @@
 import os
+import re
+from typing import AsyncIterator
 
 from lab04.bot import locals
 from lab04.bot.clients import LlamaClient, GPTClient
+from lab04.lib.cache import AsyncResponseCache
 from lab04.lib.client.abc import BaseLLMClient
+from lab04.lib.scheduler import ProviderScheduler
 
 SYSTEM_PROMPT = '''\
 Ответь текстом без форматирования. Вместо этого добавь эмодзи к каждому логическому пункту ответа. Будь лаконичен'
@@ -23,11 +27,30 @@ PROMPT_TEMPLATE = '''\
 каждого варианта напиши примерный ценовой диапазон на рынке, и состояние автомобиля за эти деньги.
 '''
 
+NOT_MATTER_ANSWERS = {'-', 'не важно', 'неважно', 'нет'}
+
+
+def normalize_answer(answer: str) -> str:
+    """Приводит ответ пользователя к каноническому виду, чтобы одинаковые по смыслу ответы давали один ключ кэша"""
+    answer = re.sub(r'\s+', ' ', answer).strip().lower()
+    return '-' if answer.strip('.!') in NOT_MATTER_ANSWERS else answer
+
+
 class LlmService:
     """Обертка над клиентом к LLM, реализующая логику формирования текстового запроса к модели"""
 
-    def __init__(self, client: BaseLLMClient):
+    def __init__(
+        self, client: BaseLLMClient, cache: AsyncResponseCache | None = None, scheduler: ProviderScheduler | None = None,
+    ):
         self.client = client
+        self.cache = cache or AsyncResponseCache(
+            max_size=int(os.getenv('LLM_CACHE_SIZE', 1000)),
+            ttl=float(os.getenv('LLM_CACHE_TTL', 60 * 60)),
+        )
+        self.scheduler = scheduler or ProviderScheduler(
+            max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', 10)),
+            max_queue=int(os.getenv('LLM_MAX_QUEUE', 50)),
+        )
 
     async def search_vehicles(
         self,
@@ -37,8 +60,58 @@ class LlmService:
         features: str,
         condition: locals.Condition,
         models: str,
+        use_cache: bool = True,
+    ) -> str:
+        """
+        Подбирает автомобили по ответам пользователя
+
+        Ответы кэшируются по нормализованным данным формы, use_cache=False принудительно запрашивает новый ответ
+        """
+        text = self._format_prompt(budget, vehicle_type, purpose, features, condition, models)
+        key = self._cache_key(budget, vehicle_type, purpose, features, condition, models)
+        return await self.cache.get_or_compute(key, lambda: self._request(text), bypass=not use_cache)
+
+    async def stream_vehicles(
+        self,
+        budget: str,
+        vehicle_type: str,
+        purpose: str,
+        features: str,
+        condition: locals.Condition,
+        models: str,
+        use_cache: bool = True,
+    ) -> AsyncIterator[str]:
+        """
+        То же, что search_vehicles, но возвращает ответ по частям по мере генерации
+
+        Каждое значение — весь полученный к этому моменту текст. Закэшированный ответ возвращается сразу целиком, а
+        одновременные одинаковые запросы читают один общий поток от модели
+        """
+        text = self._format_prompt(budget, vehicle_type, purpose, features, condition, models)
+        key = self._cache_key(budget, vehicle_type, purpose, features, condition, models)
+        stream = self.cache.get_or_stream(key, lambda: self._stream(text), bypass=not use_cache)
+        async for result in stream:
+            yield result
+
+    async def _request(self, text: str) -> str:
+        async with self.scheduler.slot():
+            return await self.client.request(SYSTEM_PROMPT, text)
+
+    async def _stream(self, text: str) -> AsyncIterator[str]:
+        async with self.scheduler.slot():
+            async for result in self.client.stream(SYSTEM_PROMPT, text):
+                yield result
+
+    @staticmethod
+    def _format_prompt(
+        budget: str,
+        vehicle_type: str,
+        purpose: str,
+        features: str,
+        condition: locals.Condition,
+        models: str,
     ) -> str:
-        text = PROMPT_TEMPLATE.format(
+        return PROMPT_TEMPLATE.format(
             budget=budget,
             vehicle_type=vehicle_type,
             purpose=purpose,
@@ -46,7 +119,19 @@ class LlmService:
             condition=condition,
             models=models,
         )
-        return await self.client.request(SYSTEM_PROMPT, text)
+
+    def _cache_key(
+        self,
+        budget: str,
+        vehicle_type: str,
+        purpose: str,
+        features: str,
+        condition: locals.Condition,
+        models: str,
+    ) -> tuple:
+        # Нормализуем ответы только для ключа: в промпт они попадают как есть, чтобы не терять регистр марок и моделей
+        answers = tuple(map(normalize_answer, (budget, vehicle_type, purpose, features, models)))
+        return self.client.name, getattr(self.client, 'model', None), condition, answers
 
 
 AVAILABLE_SERVICES = [
@@ -0,0 +1,158 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+from typing import AsyncIterator, Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar('T')
+
+_END = object()
+
+
+class _SharedStream:
+    """
+    Поток значений, который читается из источника один раз и раздается всем подписчикам
+
+    Каждое значение потока заменяет предыдущее, поэтому подписчик, присоединившийся позже или не успевающий за
+    источником, получает сразу последнее значение. Когда уходит последний подписчик, чтение источника отменяется
+    """
+
+    def __init__(self, source: AsyncIterator[T], on_done: Callable[[T], None]):
+        self._last = None
+        self._subscribers: list[asyncio.Queue] = []
+        self.task = asyncio.ensure_future(self._pump(source, on_done))
+        self.task.add_done_callback(self._notify_done)
+
+    async def _pump(self, source: AsyncIterator[T], on_done: Callable[[T], None]) -> None:
+        async for value in source:
+            self._last = value
+            for queue in self._subscribers:
+                queue.put_nowait(value)
+        if self._last is not None:
+            on_done(self._last)
+
+    def _notify_done(self, _: asyncio.Task) -> None:
+        for queue in self._subscribers:
+            queue.put_nowait(_END)
+
+    async def follow(self) -> AsyncIterator[T]:
+        queue = asyncio.Queue()
+        if self._last is not None:
+            queue.put_nowait(self._last)
+        if self.task.done():
+            queue.put_nowait(_END)
+        self._subscribers.append(queue)
+        try:
+            while True:
+                items = [await queue.get()]
+                while not queue.empty():
+                    items.append(queue.get_nowait())
+                values = [item for item in items if item is not _END]
+                if values:
+                    yield values[-1]
+                if items[-1] is _END:
+                    # Пробрасывает ошибку источника всем подписчикам
+                    self.task.result()
+                    return
+        finally:
+            self._subscribers.remove(queue)
+            if not self._subscribers:
+                self.task.cancel()
+
+
+class AsyncResponseCache:
+    """
+    LRU-кэш результатов асинхронных запросов с ограничением времени жизни записей
+
+    Одновременные запросы с одинаковым ключом объединяются: выполняется только первый, остальные ждут его результат
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, object]] = OrderedDict()
+        self._in_flight: dict[Hashable, asyncio.Task] = {}
+        self._streams: dict[Hashable, _SharedStream] = {}
+        self._waiters: dict[asyncio.Task, int] = {}
+
+    def get(self, key: Hashable) -> object | None:
+        """Возвращает значение из кэша или None, если его нет или оно устарело"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created, value = entry
+        if monotonic() - created > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: object) -> None:
+        """Сохраняет значение, вытесняя давно не использованные записи сверх max_size"""
+        self._entries[key] = (monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[T]], bypass: bool = False) -> T:
+        """
+        Возвращает закэшированное значение или вычисляет его через compute()
+
+        При bypass=True кэш и уже выполняющиеся запросы игнорируются, но новое значение сохраняется в кэш. Отмена
+        ожидающего не прерывает вычисление, пока его результат ждет кто-то еще, а с уходом последнего оно отменяется
+        """
+        task = None
+        if not bypass:
+            value = self.get(key)
+            if value is not None:
+                return value
+            task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(key, compute))
+            if not bypass:
+                self._in_flight[key] = task
+                task.add_done_callback(lambda _: self._in_flight.pop(key) if self._in_flight.get(key) is task else None)
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # shield: отмена одного из ожидающих не должна отменять запрос для остальных
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    task.cancel()
+                    if self._in_flight.get(key) is task:
+                        del self._in_flight[key]
+
+    async def _compute(self, key: Hashable, compute: Callable[[], Awaitable[T]]) -> T:
+        value = await compute()
+        self.set(key, value)
+        return value
+
+    async def get_or_stream(
+        self, key: Hashable, open_stream: Callable[[], AsyncIterator[T]], bypass: bool = False,
+    ) -> AsyncIterator[T]:
+        """
+        Потоковый вариант get_or_compute для потоков, каждое значение которых заменяет предыдущее
+
+        Закэшированное значение возвращается сразу целиком. Одновременные запросы с одинаковым ключом читают один общий
+        поток из open_stream(), последнее его значение сохраняется в кэш. При bypass=True кэш и уже открытые потоки
+        игнорируются
+        """
+        stream = None
+        if not bypass:
+            value = self.get(key)
+            if value is not None:
+                yield value
+                return
+            stream = self._streams.get(key)
+        if stream is None:
+            stream = _SharedStream(open_stream(), on_done=lambda value: self.set(key, value))
+            if not bypass:
+                self._streams[key] = stream
+                stream.task.add_done_callback(
+                    lambda _: self._streams.pop(key) if self._streams.get(key) is stream else None,
+                )
+        async for value in stream.follow():
+            yield value
@@ -1,11 +1,67 @@
+import asyncio
+import json as jsonlib
+import random
+import statistics
 from abc import ABC, abstractmethod
+from collections import deque
+from time import monotonic
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Awaitable, Callable, TypeVar
 
-from aiohttp import ClientSession
+from aiohttp import (
+    ClientConnectionError, ClientResponse, ClientResponseError, ClientSession, TCPConnector, TraceConfig,
+    TraceConnectionCreateEndParams, TraceConnectionCreateStartParams,
+)
+
+from lab04.lib.metrics import REGISTRY, SIZE_BUCKETS
+
+LLM_CONNECT_SECONDS = REGISTRY.histogram('llm_connect_seconds', 'Время установки нового соединения с провайдером')
+LLM_TTFB_SECONDS = REGISTRY.histogram('llm_ttfb_seconds', 'Время от отправки запроса до заголовков ответа')
+LLM_REQUEST_SECONDS = REGISTRY.histogram('llm_request_seconds', 'Полное время запроса к провайдеру, включая повторы')
+LLM_ERRORS = REGISTRY.counter('llm_errors_total', 'Ошибки запросов к провайдеру по статусу')
+LLM_IN_FLIGHT = REGISTRY.gauge('llm_in_flight', 'Число выполняющихся запросов к провайдеру')
+LLM_REQUEST_BYTES = REGISTRY.histogram('llm_request_bytes', 'Размер тела запроса', SIZE_BUCKETS)
+LLM_RESPONSE_BYTES = REGISTRY.histogram('llm_response_bytes', 'Размер тела ответа', SIZE_BUCKETS)
+
+
+async def _on_connection_create_start(
+    session: ClientSession, context: SimpleNamespace, params: TraceConnectionCreateStartParams,
+) -> None:
+    context.connect_start = monotonic()
+
+
+async def _on_connection_create_end(
+    session: ClientSession, context: SimpleNamespace, params: TraceConnectionCreateEndParams,
+) -> None:
+    provider = (context.trace_request_ctx or {}).get('provider')
+    LLM_CONNECT_SECONDS.observe(monotonic() - context.connect_start, provider=provider)
+
+
+T = TypeVar('T')
+
+TRACE_CONFIG = TraceConfig()
+TRACE_CONFIG.on_connection_create_start.append(_on_connection_create_start)
+TRACE_CONFIG.on_connection_create_end.append(_on_connection_create_end)
 
 
 class BaseLLMClient(ABC):
     """Базовый клиент к LLM-модели"""
 
+    LIMIT = 100  # общее ограничение на число соединений в пуле
+    LIMIT_PER_HOST = 10  # ограничение на число соединений к одному хосту
+    KEEPALIVE_TIMEOUT = 30.0  # сколько секунд держать простаивающее соединение открытым
+    DNS_CACHE_TTL = 300  # время жизни DNS-кэша в секундах
+
+    TIMEOUT = 60.0  # общий дедлайн запроса в секундах, включая повторы
+    MAX_RETRIES = 2  # число повторов при ответах 429/5xx и ошибках соединения
+    RETRY_BACKOFF = 0.5  # базовая задержка перед повтором, растет экспоненциально со случайным разбросом
+    HEDGE = False  # отправлять ли дублирующий запрос, если ответ (у потока — первая строка) задерживается дольше p95
+    HEDGE_MIN_SAMPLES = 20  # сколько замеров задержки нужно, прежде чем начать дублировать запросы
+
+    _session: ClientSession | None = None
+    _latencies: deque[float] | None = None  # задержки последних ответов request()
+    _stream_latencies: deque[float] | None = None  # задержки до первой строки последних ответов stream()
+
     @property
     @abstractmethod
     def name(self) -> str:
@@ -25,16 +81,174 @@ class BaseLLMClient(ABC):
     def URL(self) -> str:
         pass
 
+    async def start(self) -> None:
+        """Открывает пул соединений клиента, живущий до вызова close()"""
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(
+                    limit=self.LIMIT,
+                    limit_per_host=self.LIMIT_PER_HOST,
+                    keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=self.DNS_CACHE_TTL,
+                ),
+                trace_configs=[TRACE_CONFIG],
+            )
+
+    async def close(self) -> None:
+        """Закрывает пул соединений клиента"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
     async def request(self, system_prompt: str, text: str, max_tokens: int = 500, temperature: float = 0.3) -> str:
-        async with ClientSession() as session:
-            async with session.post(
-                self.URL,
-                json=self._prepare_json(system_prompt, text, max_tokens, temperature),
-                headers=self.headers,
-            ) as r:
+        try:
+            async with asyncio.timeout(self.TIMEOUT):
+                json = self._prepare_json(system_prompt, text, max_tokens, temperature)
+                if not self.HEDGE or (delay := self._hedge_delay(self._latencies)) is None:
+                    return await self._request_once(json)
+                return await self._hedged(lambda: self._request_once(json), delay)
+        except TimeoutError:
+            LLM_ERRORS.inc(provider=self.name, status='timeout')
+            raise
+
+    async def _request_once(self, json: dict[str, Any]) -> str:
+        start = monotonic()
+        LLM_IN_FLIGHT.inc(provider=self.name)
+        try:
+            async with await self._post(json) as r:
+                body = await r.read()
+                LLM_RESPONSE_BYTES.observe(len(body), provider=self.name)
+                result = self._parse_json(await r.json())
+        finally:
+            LLM_IN_FLIGHT.dec(provider=self.name)
+        elapsed = monotonic() - start
+        LLM_REQUEST_SECONDS.observe(elapsed, provider=self.name)
+        if self._latencies is None:
+            self._latencies = deque(maxlen=100)
+        self._latencies.append(elapsed)
+        return result
+
+    async def _open_stream(self, json: dict[str, Any]) -> tuple[ClientResponse, bytes]:
+        """Отправляет потоковый запрос и дожидается первой строки ответа"""
+        start = monotonic()
+        r = await self._post(json)
+        try:
+            line = await r.content.readline()
+        except BaseException:
+            r.release()
+            raise
+        if self._stream_latencies is None:
+            self._stream_latencies = deque(maxlen=100)
+        self._stream_latencies.append(monotonic() - start)
+        return r, line
+
+    async def _hedged(
+        self, attempt: Callable[[], Awaitable[T]], delay: float, discard: Callable[[T], None] | None = None,
+    ) -> T:
+        """
+        Если attempt() не завершилась за delay секунд, запускает дублирующую попытку и возвращает первый успешный
+        результат. Результат проигравшей попытки, если она тоже успела завершиться, передается в discard
+        """
+        tasks = {asyncio.create_task(attempt())}
+        started = set(tasks)
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                task = asyncio.create_task(attempt())
+                tasks.add(task)
+                started.add(task)
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in started - {winner}:
+                if not task.done():
+                    task.cancel()
+                elif discard is not None and not task.cancelled() and task.exception() is None:
+                    discard(task.result())
+
+    def _hedge_delay(self, latencies: deque[float] | None) -> float | None:
+        """p95 задержки последних запросов или None, если замеров пока мало"""
+        if latencies is None or len(latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return statistics.quantiles(latencies, n=20)[-1]
+
+    async def _post(self, json: dict[str, Any]) -> ClientResponse:
+        """Отправляет запрос, повторяя его с экспоненциальной задержкой при ответах 429/5xx и ошибках соединения"""
+        await self.start()
+        LLM_REQUEST_BYTES.observe(len(jsonlib.dumps(json).encode()), provider=self.name)
+        for attempt in range(self.MAX_RETRIES + 1):
+            try:
+                start = monotonic()
+                r = await self._session.post(
+                    self.URL, json=json, headers=self.headers, trace_request_ctx={'provider': self.name},
+                )
+                LLM_TTFB_SECONDS.observe(monotonic() - start, provider=self.name)
                 r.raise_for_status()
-                return self._parse_json(await r.json())
+                return r
+            except ClientResponseError as e:
+                r.release()
+                LLM_ERRORS.inc(provider=self.name, status=e.status)
+                if attempt == self.MAX_RETRIES or (e.status != 429 and e.status < 500):
+                    raise
+            except ClientConnectionError:
+                LLM_ERRORS.inc(provider=self.name, status='connection')
+                if attempt == self.MAX_RETRIES:
+                    raise
+            await asyncio.sleep(random.uniform(0, self.RETRY_BACKOFF * 2 ** attempt))
+
+    async def stream(
+        self, system_prompt: str, text: str, max_tokens: int = 500, temperature: float = 0.3,
+    ) -> AsyncIterator[str]:
+        """
+        Возвращает ответ по частям по мере генерации, каждое значение — весь полученный к этому моменту текст
+
+        При HEDGE дублирующий запрос отправляется, если первая строка ответа задерживается дольше p95
+        """
+        json = self._prepare_stream_json(system_prompt, text, max_tokens, temperature)
+        start = monotonic()
+        size = 0
+        LLM_IN_FLIGHT.inc(provider=self.name)
+        try:
+            if not self.HEDGE or (delay := self._hedge_delay(self._stream_latencies)) is None:
+                r, line = await self._open_stream(json)
+            else:
+                r, line = await self._hedged(
+                    lambda: self._open_stream(json), delay, discard=lambda opened: opened[0].release(),
+                )
+            async with r:
+                result = ''
+                while line:
+                    size += len(line)
+                    decoded = line.decode().strip()
+                    if decoded:
+                        updated = self._parse_stream_line(decoded, result)
+                        if updated is None:
+                            break
+                        if updated != result:
+                            result = updated
+                            yield result
+                    line = await r.content.readline()
+        finally:
+            LLM_IN_FLIGHT.dec(provider=self.name)
+        LLM_RESPONSE_BYTES.observe(size, provider=self.name)
+        LLM_REQUEST_SECONDS.observe(monotonic() - start, provider=self.name)
 
     @abstractmethod
     def _parse_json(self, data: dict) -> str:
         pass
+
+    @abstractmethod
+    def _prepare_stream_json(self, system_prompt: str, text: str, max_tokens: int, temperature: float) -> dict:
+        pass
+
+    @abstractmethod
+    def _parse_stream_line(self, line: str, text: str) -> str | None:
+        """Возвращает текст ответа с учетом очередной строки потока text или None, если поток завершен"""
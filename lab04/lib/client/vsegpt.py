@@ -1,3 +1,4 @@
+import json
 from abc import ABC, abstractmethod
 from functools import cached_property
 from typing import Any
@@ -40,3 +41,15 @@ class VsegptClient(BaseLLMClient, ABC):
 
     def _parse_json(self, data: dict) -> str:
         return data['choices'][0]['message']['content']
+
+    def _prepare_stream_json(self, system_prompt: str, text: str, max_tokens: int, temperature: float) -> dict[str, Any]:
+        return {**self._prepare_json(system_prompt, text, max_tokens, temperature), 'stream': True}
+
+    def _parse_stream_line(self, line: str, text: str) -> str | None:
+        # Server-Sent Events в формате OpenAI: каждая строка "data: {...}" содержит приращение текста
+        if not line.startswith('data:'):
+            return text
+        data = line.removeprefix('data:').strip()
+        if data == '[DONE]':
+            return None
+        return text + (json.loads(data)['choices'][0]['delta'].get('content') or '')
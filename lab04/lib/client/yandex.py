@@ -1,3 +1,4 @@
+import json
 from abc import ABC, abstractmethod
 from functools import cached_property
 from typing import Any
@@ -40,3 +41,12 @@ class YandexFoundationModelsClient(BaseLLMClient, ABC):
 
     def _parse_json(self, data: dict) -> str:
         return data['result']['alternatives'][0]['message']['text']
+
+    def _prepare_stream_json(self, system_prompt: str, text: str, max_tokens: int, temperature: float) -> dict[str, Any]:
+        data = self._prepare_json(system_prompt, text, max_tokens, temperature)
+        data['completionOptions']['stream'] = True
+        return data
+
+    def _parse_stream_line(self, line: str, text: str) -> str | None:
+        # Каждая строка — отдельный JSON с полным текстом, сгенерированным к этому моменту
+        return self._parse_json(json.loads(line))
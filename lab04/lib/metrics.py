@@ -0,0 +1,137 @@
+import json
+import math
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Iterable
+
+LabelsKey = tuple[tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, math.inf)
+
+
+def _labels_key(labels: dict[str, object]) -> LabelsKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: Iterable[tuple[str, str]]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in key]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric(ABC):
+    """Метрика с метками в формате Prometheus"""
+
+    @property
+    @abstractmethod
+    def type(self) -> str:
+        pass
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+    @abstractmethod
+    def to_dict(self) -> dict:
+        pass
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: dict[LabelsKey, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: object) -> None:
+        self._values[_labels_key(labels)] += amount
+
+    def render(self) -> list[str]:
+        return super().render() + [f'{self.name}{_format_labels(key)} {value}' for key, value in self._values.items()]
+
+    def to_dict(self) -> dict:
+        return {_format_labels(key): value for key, value in self._values.items()}
+
+
+class Gauge(Counter):
+    """Значение, которое может как расти, так и уменьшаться"""
+
+    type = 'gauge'
+
+    def dec(self, amount: float = 1, **labels: object) -> None:
+        self._values[_labels_key(labels)] -= amount
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = buckets
+        self._counts: dict[LabelsKey, list[int]] = {}
+        self._sums: dict[LabelsKey, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = _labels_key(labels)
+        counts = self._counts.setdefault(key, [0] * len(self.buckets))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._sums[key] += value
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for key, counts in self._counts.items():
+            for bound, count in zip(self.buckets, counts):
+                le = '+Inf' if bound == math.inf else str(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(key + (("le", le),))} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {self._sums[key]}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {counts[-1]}')
+        return lines
+
+    def to_dict(self) -> dict:
+        return {
+            _format_labels(key): {'count': counts[-1], 'sum': self._sums[key],
+                                  'buckets': dict(zip(map(str, self.buckets), counts))}
+            for key, counts in self._counts.items()
+        }
+
+
+class MetricsRegistry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._register(Gauge(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets))
+
+    def render_prometheus(self) -> str:
+        """Текстовый формат Prometheus"""
+        return '\n'.join(line for metric in self._metrics.values() for line in metric.render()) + '\n'
+
+    def dump_json(self) -> str:
+        return json.dumps({name: metric.to_dict() for name, metric in self._metrics.items()}, ensure_ascii=False)
+
+
+REGISTRY = MetricsRegistry()
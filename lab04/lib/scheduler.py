@@ -0,0 +1,57 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+
+
+class QueueFullError(Exception):
+    """Очередь запросов к провайдеру переполнена"""
+
+
+class ProviderScheduler:
+    """
+    Ограничивает нагрузку на одного провайдера LLM
+
+    Одновременно выполняется не более max_concurrency запросов, еще не более max_queue ждут своей очереди. Сверх этого
+    запросы сразу отклоняются с QueueFullError, чтобы не копить их в памяти
+    """
+
+    def __init__(self, max_concurrency: int = 10, max_queue: int = 50):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+
+    @property
+    def waiting(self) -> int:
+        """Число запросов, ожидающих в очереди"""
+        return self._waiting
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Занимает место для запроса к провайдеру на время выполнения блока"""
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            raise QueueFullError('Слишком много запросов к провайдеру')
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+class UserTasks:
+    """Хранит выполняющуюся задачу каждого пользователя и отменяет ее, когда пользователь запускает новую"""
+
+    def __init__(self):
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+
+    def replace(self, user: Hashable, task: asyncio.Task) -> None:
+        """Регистрирует задачу пользователя, отменяя предыдущую, если она еще выполняется"""
+        previous = self._tasks.get(user)
+        if previous is not None and previous is not task and not previous.done():
+            previous.cancel()
+        self._tasks[user] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user, None) if self._tasks.get(user) is task else None)
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import sqlite3
+import threading
+from time import time
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram в SQLite-файле
+
+    База открывается в режиме WAL, поэтому ее могут одновременно использовать несколько процессов бота, а состояние
+    переживает перезапуск. Записи накапливаются в памяти и сбрасываются в базу одной транзакцией не реже, чем раз в
+    flush_interval секунд. Диалоги, не обновлявшиеся дольше ttl секунд, считаются брошенными и удаляются
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 60 * 60, flush_interval: float = 0.05):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._pending: dict[str, dict[str, Any]] = {}
+        # Пачки, которые уже забраны из _pending, но еще не закоммичены
+        self._flushing: list[dict[str, dict[str, Any]]] = []
+        self._flush_task: asyncio.Task | None = None
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Соединение с базой, открывается при первом обращении, чтобы не наследоваться процессами-воркерами"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('PRAGMA busy_timeout=5000')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, '
+                               "data TEXT NOT NULL DEFAULT '{}', updated REAL NOT NULL)")
+            self._conn.execute('CREATE INDEX IF NOT EXISTS fsm_updated ON fsm (updated)')
+        return self._conn
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ':'.join(map(str, (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny,
+        )))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._write(self._key(key), state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._read(self._key(key)))['state']
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        self._write(self._key(key), data=data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._read(self._key(key)))['data'].copy()
+
+    async def close(self) -> None:
+        """Сбрасывает накопленные записи и закрывает соединение, повторный вызов ничего не делает"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write_pending()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _write(self, key: str, **fields: Any) -> None:
+        self._pending.setdefault(key, {}).update(fields)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _read(self, key: str) -> dict[str, Any]:
+        # Пачка может закоммититься, пока идет SELECT, поэтому запоминаем несохраненные записи до него
+        # и дополняем теми, что появились после; пачки накладываются от старых к новым
+        overlays = [*self._flushing, self._pending]
+        row = await asyncio.to_thread(self._select, key)
+        overlays += [*self._flushing, self._pending]
+        record = {'state': None, 'data': {}}
+        if row is not None and time() - row[2] <= self.ttl:
+            record = {'state': row[0], 'data': json.loads(row[1])}
+        # Еще не сброшенные в базу записи новее сохраненных
+        for batch in overlays:
+            record.update(batch.get(key, {}))
+        return record
+
+    def _select(self, key: str) -> tuple | None:
+        with self._lock:
+            return self.conn.execute('SELECT state, data, updated FROM fsm WHERE key = ?', (key,)).fetchone()
+
+    async def _write_pending(self) -> None:
+        """Записывает накопленные записи в базу, до коммита они остаются видны чтению через _flushing"""
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        self._flushing.append(batch)
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        finally:
+            self._flushing.remove(batch)
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self._write_pending()
+
+    def _write_batch(self, batch: dict[str, dict[str, Any]]) -> None:
+        if not batch:
+            return
+        now = time()
+        with self._lock:
+            conn = self.conn
+            conn.execute('BEGIN')
+            try:
+                # Просроченные записи удаляются до вставки, иначе запись одного состояния оживила бы старые данные
+                conn.execute('DELETE FROM fsm WHERE updated < ?', (now - self.ttl,))
+                for key, fields in batch.items():
+                    if 'state' in fields:
+                        conn.execute(
+                            'INSERT INTO fsm (key, state, updated) VALUES (?, ?, ?) '
+                            'ON CONFLICT (key) DO UPDATE SET state = excluded.state, updated = excluded.updated',
+                            (key, fields['state'], now),
+                        )
+                    if 'data' in fields:
+                        conn.execute(
+                            'INSERT INTO fsm (key, data, updated) VALUES (?, ?, ?) '
+                            'ON CONFLICT (key) DO UPDATE SET data = excluded.data, updated = excluded.updated',
+                            (key, json.dumps(fields['data'], ensure_ascii=False), now),
+                        )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
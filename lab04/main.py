@@ -1,7 +1,36 @@
+import argparse
 import asyncio
+import multiprocessing
+import os
 
-from lab04.bot.bot import run_bot
+from lab04.bot.bot import run_bot, run_webhook, set_webhook
 
 if __name__ == '__main__':
-    print('Запускаем поллинг')
-    asyncio.run(run_bot())
+    parser = argparse.ArgumentParser(description='Бот-автоподборщик')
+    parser.add_argument('--webhook', action='store_true', help='Получать обновления через вебхук вместо поллинга')
+    parser.add_argument('--host', default=os.getenv('WEBHOOK_HOST', '127.0.0.1'), help='Адрес для вебхук-сервера')
+    parser.add_argument('--port', type=int, default=int(os.getenv('WEBHOOK_PORT', 8080)), help='Порт вебхук-сервера')
+    parser.add_argument('--path', default=os.getenv('WEBHOOK_PATH', '/webhook'), help='Путь вебхука')
+    parser.add_argument('--url', default=os.getenv('WEBHOOK_URL'), help='Публичный адрес вебхука для Telegram')
+    parser.add_argument('--workers', type=int, default=1, help='Число процессов вебхук-сервера')
+    args = parser.parse_args()
+    if args.workers > 1 and not os.getenv('FSM_STORAGE_PATH'):
+        # Обновления одного пользователя попадают в разные процессы, поэтому состояние FSM должно быть общим
+        parser.error('--workers больше 1 требует общего хранилища состояний: задайте FSM_STORAGE_PATH')
+
+    if not args.webhook:
+        print('Запускаем поллинг')
+        asyncio.run(run_bot())
+    else:
+        secret = os.getenv('WEBHOOK_SECRET')
+        if args.url:
+            asyncio.run(set_webhook(args.url + args.path, secret))
+        print(f'Запускаем вебхук на {args.host}:{args.port}{args.path}, процессов: {args.workers}')
+        workers = [
+            multiprocessing.Process(target=run_webhook, args=(args.host, args.port, args.path, secret))
+            for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()